@@ -0,0 +1,353 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for full license information.
+
+# Fakes of the Azure SDK clients used by the samples, with a configurable latency per call instead of network I/O.
+# install() replaces the clients in the SDK modules before a sample is imported. Everything else (Message,
+# MethodResponse, exceptions, ...) is taken from the installed SDK; packages that are not installed are
+# replaced by minimal stand-ins, so the benchmarks also run without the Azure SDKs.
+import asyncio
+import base64
+import importlib
+import sys
+import time
+import types
+
+# latency in seconds of every faked service call and of every sensor read, set by install()
+LATENCY = 0.0
+SENSOR_LATENCY = 0.0
+# the fake clients created by the sample, to read the counters after a run
+CLIENTS = []
+
+
+def _module(name):
+    # the installed module, or an empty stand-in when the package is not installed
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        module = types.ModuleType(name)
+        sys.modules[name] = module
+        parent, _, child = name.rpartition(".")
+        if parent:
+            setattr(_module(parent), child, module)
+        return module
+
+
+def _provide(module, name, value):
+    # only used when the installed package does not provide the name
+    if not hasattr(module, name):
+        setattr(module, name, value)
+
+
+async def _delay():
+    if LATENCY:
+        await asyncio.sleep(LATENCY)
+
+
+def _sleep(latency=None):
+    latency = LATENCY if latency is None else latency
+    if latency:
+        time.sleep(latency)
+
+
+def _body_size(data):
+    if isinstance(data, str):
+        return len(data.encode("utf-8"))
+    return len(data) if data is not None else 0
+
+
+class FakeMessage:
+
+    def __init__(self, data, message_id=None, content_encoding=None, content_type=None, output_name=None):
+        self.data = data
+        self.message_id = message_id
+        self.correlation_id = None
+        self.content_encoding = content_encoding
+        self.content_type = content_type
+        self.output_name = output_name
+        self.custom_properties = {}
+
+
+class FakeMethodResponse:
+
+    def __init__(self, request_id, status, payload=None):
+        self.request_id = request_id
+        self.status = status
+        self.payload = payload
+
+    @classmethod
+    def create_from_method_request(cls, method_request, status, payload=None):
+        return cls(method_request.request_id, status, payload)
+
+
+class FakeIoTHubClient:
+    # IoTHubDeviceClient and IoTHubModuleClient (aio): every call takes LATENCY seconds
+
+    def __init__(self):
+        self.connected = False
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.method_responses = []
+        self.reported_properties = []
+        self.desired_properties = {}
+        self.on_method_request_received = None
+        self.on_twin_desired_properties_patch_received = None
+        CLIENTS.append(self)
+
+    @classmethod
+    def create_from_connection_string(cls, connection_string, **kwargs):
+        return cls()
+
+    @classmethod
+    def create_from_symmetric_key(cls, symmetric_key, hostname, device_id, **kwargs):
+        return cls()
+
+    @classmethod
+    def create_from_edge_environment(cls, **kwargs):
+        return cls()
+
+    async def connect(self):
+        await _delay()
+        self.connected = True
+
+    async def disconnect(self):
+        self.connected = False
+
+    async def shutdown(self):
+        self.connected = False
+
+    async def send_message(self, message):
+        await _delay()
+        self.messages_sent += 1
+        self.bytes_sent += _body_size(message.data)
+
+    async def send_message_to_output(self, message, output_name):
+        await self.send_message(message)
+
+    async def send_method_response(self, method_response):
+        await _delay()
+        self.method_responses.append(method_response)
+
+    async def get_twin(self):
+        await _delay()
+        return {"desired": dict(self.desired_properties), "reported": {}}
+
+    async def patch_twin_reported_properties(self, reported_properties):
+        await _delay()
+        self.reported_properties.append(reported_properties)
+
+    async def get_storage_info_for_blob(self, blob_name):
+        await _delay()
+        return {"hostName": "benchmark.blob.core.windows.net", "containerName": "benchmark", "blobName": blob_name, "sasToken": "?sig=benchmark", "correlationId": "benchmark"}
+
+    async def notify_blob_upload_status(self, correlation_id, is_success, status_code, status_description):
+        await _delay()
+
+
+class FakeProvisioningDeviceClient:
+
+    def __init__(self, registration_id):
+        self.registration_id = registration_id
+
+    @classmethod
+    def create_from_symmetric_key(cls, provisioning_host, registration_id, id_scope, symmetric_key, **kwargs):
+        return cls(registration_id)
+
+    async def register(self):
+        await _delay()
+        state = types.SimpleNamespace(assigned_hub="benchmark.azure-devices.net", device_id=self.registration_id)
+        return types.SimpleNamespace(status="assigned", registration_state=state)
+
+
+class FakeBlobClient:
+    # BlobClient of azure-storage-blob: staging and committing a block take LATENCY seconds
+
+    def __init__(self):
+        self.staged = {}
+        CLIENTS.append(self)
+
+    @classmethod
+    def from_blob_url(cls, blob_url, **kwargs):
+        return cls()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def stage_block(self, block_id, data, **kwargs):
+        _sleep()
+        self.staged[block_id] = len(data)
+
+    def get_block_list(self, block_list_type="committed", **kwargs):
+        _sleep()
+        blocks = [types.SimpleNamespace(id=block_id, size=size) for block_id, size in self.staged.items()]
+        return [], blocks
+
+    def commit_block_list(self, block_list, **kwargs):
+        _sleep()
+        return {"etag": "benchmark"}
+
+    def upload_blob(self, data, **kwargs):
+        _sleep()
+        return {"etag": "benchmark"}
+
+
+class FakeContainerClient:
+    account_name = "benchmark"
+    container_name = "benchmark"
+    credential = types.SimpleNamespace(account_key=base64.b64encode(b"benchmark").decode("utf-8"))
+
+    def set_container_access_policy(self, signed_identifiers, **kwargs):
+        _sleep()
+
+
+class FakeBlobServiceClient:
+
+    @classmethod
+    def from_connection_string(cls, connection_string, **kwargs):
+        return cls()
+
+    def get_container_client(self, container):
+        return FakeContainerClient()
+
+
+def fake_generate_container_sas(account_name, container_name, account_key=None, policy_id=None, **kwargs):
+    return "sv=benchmark&si={}&sig=benchmark".format(policy_id)
+
+
+class FakeDigitalTwinClient:
+    # DigitalTwinClient of azure-iot-hub: invoke_command takes LATENCY seconds and echoes the payload
+
+    def __init__(self, connection_string=None, **kwargs):
+        self.commands_invoked = 0
+        CLIENTS.append(self)
+
+    def invoke_command(self, digital_twin_id, command_name, payload, connect_timeout_in_seconds=None, response_timeout_in_seconds=None):
+        _sleep()
+        self.commands_invoked += 1
+        return {"status": 200, "payload": payload}
+
+
+class FakeProvisioningServiceClient:
+    # ProvisioningServiceClient of azure-iothub-provisioningserviceclient, returns a fixed group key
+    GROUP_KEY = base64.b64encode(bytes(range(64))).decode("utf-8")
+
+    def __init__(self):
+        self.calls = 0
+        CLIENTS.append(self)
+
+    @classmethod
+    def create_from_connection_string(cls, connection_string):
+        return cls()
+
+    def get_enrollment_group_attestation_mechanism(self, enrollment_group_id):
+        _sleep()
+        self.calls += 1
+        return types.SimpleNamespace(symmetric_key=types.SimpleNamespace(primary_key=self.GROUP_KEY, secondary_key=self.GROUP_KEY))
+
+
+class FakeSenseHat:
+    # SenseHat with simulated readings; every read takes SENSOR_LATENCY seconds, like the I2C access
+
+    def get_accelerometer_raw(self):
+        _sleep(SENSOR_LATENCY)
+        return {"x": 0.01, "y": -0.02, "z": 0.98}
+
+    def get_temperature(self):
+        _sleep(SENSOR_LATENCY)
+        return 21.5
+
+    def get_pressure(self):
+        _sleep(SENSOR_LATENCY)
+        return 1013.2
+
+    def get_humidity(self):
+        _sleep(SENSOR_LATENCY)
+        return 45.3
+
+    def show_message(self, text, text_colour=None, **kwargs):
+        pass
+
+    def show_letter(self, letter, text_colour=None, **kwargs):
+        pass
+
+
+class FakeHttpRequest:
+    # stand-in for azure.functions.HttpRequest, only used when azure-functions is not installed
+
+    def __init__(self, method, url, headers=None, params=None, route_params=None, body=b""):
+        self.method = method
+        self.url = url
+        self.headers = {key.lower(): value for key, value in (headers or {}).items()}
+        self.params = dict(params or {})
+        self.route_params = dict(route_params or {})
+        self._body = body
+
+    def get_body(self):
+        return self._body
+
+    def get_json(self):
+        import json
+        return json.loads(self._body)
+
+
+class FakeHttpResponse:
+
+    def __init__(self, body=None, status_code=200, headers=None, mimetype=None, charset=None):
+        self.status_code = status_code
+        self.mimetype = mimetype
+        self._body = body.encode("utf-8") if isinstance(body, str) else body
+
+    def get_body(self):
+        return self._body
+
+
+class FakeEventHubEvent:
+    # stand-in for azure.functions.EventHubEvent, only used when azure-functions is not installed
+
+    def __init__(self, body, trigger_metadata=None, enqueued_time=None, partition_key=None, sequence_number=None, offset=None, iothub_metadata=None):
+        self._body = body
+        self.metadata = trigger_metadata
+        self.enqueued_time = enqueued_time
+        self.partition_key = partition_key
+        self.sequence_number = sequence_number
+        self.offset = offset
+        self.iothub_metadata = iothub_metadata
+
+    def get_body(self):
+        return self._body
+
+
+def install(latency=0.0, sensor_latency=0.0):
+    global LATENCY, SENSOR_LATENCY
+    LATENCY = latency
+    SENSOR_LATENCY = sensor_latency
+
+    device = _module("azure.iot.device")
+    _provide(device, "Message", FakeMessage)
+    _provide(device, "MethodResponse", FakeMethodResponse)
+    exceptions = _module("azure.iot.device.exceptions")
+    _provide(exceptions, "CredentialError", type("CredentialError", (Exception,), {}))
+    device_aio = _module("azure.iot.device.aio")
+    device_aio.IoTHubDeviceClient = type("IoTHubDeviceClient", (FakeIoTHubClient,), {})
+    device_aio.IoTHubModuleClient = type("IoTHubModuleClient", (FakeIoTHubClient,), {})
+    device_aio.ProvisioningDeviceClient = FakeProvisioningDeviceClient
+
+    _provide(_module("azure.core.exceptions"), "AzureError", type("AzureError", (Exception,), {}))
+
+    blob = _module("azure.storage.blob")
+    blob.BlobClient = FakeBlobClient
+    blob.BlobServiceClient = FakeBlobServiceClient
+    blob.generate_container_sas = fake_generate_container_sas
+    _provide(blob, "AccessPolicy", lambda permission=None, expiry=None, start=None: types.SimpleNamespace(permission=permission, expiry=expiry, start=start))
+    _provide(blob, "ContainerSasPermissions", lambda **permissions: types.SimpleNamespace(**permissions))
+
+    _module("azure.iot.hub").DigitalTwinClient = FakeDigitalTwinClient
+    _module("provisioningserviceclient").ProvisioningServiceClient = FakeProvisioningServiceClient
+    _module("sense_hat").SenseHat = FakeSenseHat
+
+    functions = _module("azure.functions")
+    _provide(functions, "HttpRequest", FakeHttpRequest)
+    _provide(functions, "HttpResponse", FakeHttpResponse)
+    _provide(functions, "EventHubEvent", FakeEventHubEvent)
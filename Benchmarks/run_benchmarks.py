@@ -0,0 +1,266 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for full license information.
+
+# Benchmarks of the samples against the latency fakes of the Azure SDK clients (fakes.py), to catch performance regressions.
+# Every benchmark runs the unchanged sample code in its own process (the samples have modules with the same names),
+# with a fixed random seed and fixed inputs.
+#
+#   python run_benchmarks.py                                  run all benchmarks
+#   python run_benchmarks.py --only device,eventhub --latency 0.02
+#   python run_benchmarks.py --output baseline.json           save the results
+#   python run_benchmarks.py --baseline baseline.json         exit with 1 if a result is more than --tolerance worse
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import fakes
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEVICE_DIR = os.path.join(ROOT, "Device", "IoT-SDK")
+SENSEHAT_DIR = os.path.join(ROOT, "EdgeModules", "PythonEdgeSolution", "modules", "SenseHatModule")
+DEVICE_TO_CLOUD_SERVICE_DIR = os.path.join(ROOT, "Scenario", "DeviceCallsCloudService")
+GROUP_ENROLLMENT_DIR = os.path.join(ROOT, "Provisioning", "GroupEnrollmentFunction")
+
+BENCHMARKS = ("device", "sensehat", "eventhub", "enrollment")
+
+
+async def run_for(coroutine, duration):
+    # runs a sample's main() for `duration` seconds, then cancels it
+    task = asyncio.ensure_future(coroutine)
+    await asyncio.sleep(duration)
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+def benchmark_device(args):
+    # messages/s of IotDevice.main(): the telemetry loop runs without interval, so the sender pipeline is the limit
+    sys.path.insert(0, DEVICE_DIR)
+    import IotDevice
+
+    IotDevice.CONNECTION_STRING = "HostName=benchmark.azure-devices.net;DeviceId=benchmark;SharedAccessKey=YmVuY2htYXJr"
+    IotDevice.INTERVAL = 0
+    IotDevice.BATCH_MAX_COUNT = args.batch
+    IotDevice.METRICS_PORT = None
+    IotDevice.METRICS_REPORT_INTERVAL = 3600
+
+    readings = [0]
+    create_telemetry_message = IotDevice.create_telemetry_message
+
+    def counting_create_telemetry_message(body, batch):
+        readings[0] += len(batch)
+        return create_telemetry_message(body, batch)
+
+    IotDevice.create_telemetry_message = counting_create_telemetry_message
+
+    started = time.perf_counter()
+    asyncio.run(run_for(IotDevice.main(), args.duration))
+    elapsed = time.perf_counter() - started
+    client = fakes.CLIENTS[0]
+    return {
+        "messagesPerSecond": client.messages_sent / elapsed,
+        "readingsPerSecond": readings[0] / elapsed,
+        "bytesPerMessage": client.bytes_sent / max(client.messages_sent, 1)
+    }
+
+
+def benchmark_sensehat(args):
+    # cost of one aggregation window of the SenseHat module: sampling, aggregation, encoding and sending
+    os.environ.update({
+        "ReadInterval": str(args.window),
+        "AccelerometerSampleRate": str(args.sample_rate),
+        "TemperatureSampleRate": "10",
+        "PressureSampleRate": "10",
+        "HumiditySampleRate": "10",
+        "JitterReportInterval": str(args.duration),
+        "SendStatistics": "true"
+    })
+    sys.path.insert(0, SENSEHAT_DIR)
+    import main as sensehat
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    # a little longer than the report interval, so the module reports its metrics once
+    asyncio.run(run_for(sensehat.main(), args.duration + min(args.window, 0.5)))
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+
+    client = fakes.CLIENTS[0]
+    windows = max(client.messages_sent, 1)
+    report = next((reported["Metrics"] for reported in reversed(client.reported_properties) if "Metrics" in reported), {})
+    send_data = report.get("send_data_duration_seconds", {})
+    return {
+        "windowsPerSecond": client.messages_sent / elapsed,
+        "cpuMsPerWindow": cpu / windows * 1000,
+        "sendDataMeanMs": send_data.get("meanMs"),
+        "sendDataP95Ms": send_data.get("p95Ms"),
+        "samplesPerWindow": args.sample_rate * args.window
+    }
+
+
+def create_events(count, devices, func, first_sequence_number=0):
+    # IoT Hub messages routed to the Event Hub, from `devices` devices, with the request id and creation time the devices set
+    now = datetime.datetime.utcnow()
+    body = json.dumps({"TriggerCloudService": True}).encode("utf-8")
+    device_ids = ["device-{:05d}".format(random.randrange(devices)) for _ in range(count)]
+    sequence_numbers = range(first_sequence_number, first_sequence_number + count)
+    metadata = {"PropertiesArray": [{"TriggerCloudService": "true", "requestId": "request-{}".format(sequence_number), "creationTimeMs": str(int(time.time() * 1000) - 100)}
+                                    for sequence_number in sequence_numbers]}
+    return [func.EventHubEvent(body=body, trigger_metadata=metadata, enqueued_time=now, sequence_number=sequence_number, iothub_metadata={"connection-device-id": device_id})
+            for sequence_number, device_id in zip(sequence_numbers, device_ids)]
+
+
+def benchmark_eventhub(args):
+    # events/s of IotDeviceToCloudServiceFunction for batches of `batch` events
+    os.environ.update({
+        "AZURE_STORAGE_CONNECTION_STRING": "DefaultEndpointsProtocol=https;AccountName=benchmark;AccountKey=YmVuY2htYXJr",
+        "AZURE_STORAGE_CONTAINER_NAME": "benchmark",
+        "IOTHUB_CONNECTION_STRING": "HostName=benchmark.azure-devices.net;SharedAccessKeyName=service;SharedAccessKey=YmVuY2htYXJr"
+    })
+    sys.path.insert(0, DEVICE_TO_CLOUD_SERVICE_DIR)
+    import azure.functions as func
+    import IotDeviceToCloudServiceFunction as function
+
+    # every batch has new events, the function skips events it has processed before; only main() is timed
+    events = 0
+    elapsed = 0.0
+    while elapsed < args.duration:
+        batch = create_events(args.batch, args.devices, func, events)
+        started = time.perf_counter()
+        function.main(batch)
+        elapsed += time.perf_counter() - started
+        events += len(batch)
+    return {
+        "eventsPerSecond": events / elapsed,
+        "commandsPerSecond": sum(getattr(client, "commands_invoked", 0) for client in fakes.CLIENTS) / elapsed
+    }
+
+
+def benchmark_enrollment(args):
+    # keys/s of CreateGroupEnrollementKeyFunction, for single requests and for JSON batches
+    os.environ.update({
+        "DpsConnectionString": "HostName=benchmark.azure-devices-provisioning.net;SharedAccessKeyName=provisioningserviceowner;SharedAccessKey=YmVuY2htYXJr",
+        "DpsEnrollmentGroupName": "benchmark"
+    })
+    sys.path.insert(0, GROUP_ENROLLMENT_DIR)
+    import azure.functions as func
+    import CreateGroupEnrollementKeyFunction as function
+
+    def measure(create_request, keys_per_request):
+        keys = 0
+        index = 0
+        started = time.perf_counter()
+        while time.perf_counter() - started < args.duration / 2:
+            response = function.main(create_request(index))
+            if response.status_code != 200:
+                raise RuntimeError("Unexpected response {}: {}".format(response.status_code, response.get_body()))
+            keys += keys_per_request
+            index += 1
+        return keys / (time.perf_counter() - started)
+
+    def single_request(index):
+        return func.HttpRequest(method="GET", url="/api/CreateGroupEnrollementKeyFunction", params={"deviceid": "device-{:09d}".format(index)}, body=b"")
+
+    batch_body = json.dumps(["device-{:09d}".format(index) for index in range(args.batch)]).encode("utf-8")
+
+    def batch_request(index):
+        return func.HttpRequest(method="POST", url="/api/CreateGroupEnrollementKeyFunction", headers={"content-type": "application/json"}, params={}, body=batch_body)
+
+    return {
+        "singleKeysPerSecond": measure(single_request, 1),
+        "batchKeysPerSecond": measure(batch_request, args.batch)
+    }
+
+
+def run_benchmark(name, args):
+    # in the benchmark process: install the fakes, run the sample with its console output discarded
+    random.seed(args.seed)
+    fakes.install(args.latency, args.sensor_latency)
+    logging.disable(logging.WARNING)
+    with tempfile.TemporaryDirectory() as directory:
+        # files written by the samples (config.json, offline queue, ...) go to a temporary directory
+        os.chdir(directory)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            result = globals()["benchmark_" + name](args)
+    return result
+
+
+def is_regression(metric, value, baseline, tolerance):
+    if value is None or baseline is None:
+        return False
+    # throughput: higher is better, durations (Ms): lower is better
+    if metric.endswith("PerSecond"):
+        return value < baseline * (1 - tolerance)
+    if metric.endswith("Ms"):
+        return value > baseline * (1 + tolerance)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the samples against latency fakes of the Azure SDK clients.")
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help="comma separated benchmarks: " + ", ".join(BENCHMARKS))
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds every faked service call takes")
+    parser.add_argument("--sensor-latency", type=float, default=0.0005, help="seconds every SenseHat sensor read takes")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per benchmark")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative deviation from the baseline that counts as a regression")
+    parser.add_argument("--run", choices=BENCHMARKS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # batch sizes and rates of the benchmarks, fixed so results are comparable between runs
+    args.batch = {"device": 1, "eventhub": 64, "enrollment": 1000}.get(args.run, 1)
+    args.devices = 1000
+    args.window = 0.5
+    args.sample_rate = 200
+
+    if args.run:
+        print(json.dumps(run_benchmark(args.run, args)))
+        return
+
+    results = {}
+    for name in args.only.split(","):
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark {}".format(name))
+        command = [sys.executable, os.path.abspath(__file__), "--run", name, "--latency", str(args.latency), "--sensor-latency", str(args.sensor_latency), "--duration", str(args.duration), "--seed", str(args.seed)]
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, env=dict(os.environ, PYTHONHASHSEED="0"))
+        if process.returncode != 0:
+            print("{} failed:\n{}".format(name, process.stderr))
+            results[name] = None
+            continue
+        results[name] = json.loads(process.stdout.strip().splitlines()[-1])
+        print("{:<12}{}".format(name, ", ".join("{} {}".format(metric, "-" if value is None else "{:.2f}".format(value)) for metric, value in results[name].items())))
+
+    results["settings"] = {"latency": args.latency, "sensorLatency": args.sensor_latency, "duration": args.duration, "seed": args.seed, "python": sys.version.split()[0]}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    failed = any(result is None for name, result in results.items() if name != "settings")
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        for name, result in results.items():
+            if name == "settings" or not result or not baseline.get(name):
+                continue
+            for metric, value in result.items():
+                if is_regression(metric, value, baseline[name].get(metric), args.tolerance):
+                    print("Regression in {} {}: {:.2f}, baseline {:.2f}".format(name, metric, value, baseline[name][metric]))
+                    failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,33 @@
 # Copyright (c) Microsoft. All rights reserved.
 # Licensed under the MIT license. See LICENSE file in the project root for full license information.
+import math
 import random
-import time
-import threading
 import os
+import sys
 import asyncio
 import json
+import time
+import uuid
 
 # Using the Python Device SDK for IoT Hub:
 #   https://github.com/Azure/azure-iot-sdk-python
-from azure.iot.device import ProvisioningDeviceClient, IoTHubDeviceClient, Message, MethodResponse
+# The asyncio flavour of the clients is used, so telemetry and direct methods share one event loop.
+from azure.iot.device.aio import ProvisioningDeviceClient, IoTHubDeviceClient
+from azure.iot.device import Message, MethodResponse
+from azure.iot.device.exceptions import CredentialError
 from azure.core.exceptions import AzureError
 from azure.storage.blob import BlobClient
 
+from telemetry_sender import TelemetrySender, MAX_MESSAGE_BYTES
+from offline_queue import OfflineQueue
+from payload_encoding import create_encoder
+from blob_upload import BlobUploader
+from registration_cache import RegistrationCache
+from config_store import ConfigStore
+from metrics import Metrics, start_metrics_server, creation_timestamp, CREATION_TIME_PROPERTY
+from request_correlation import RequestCorrelator
+from connection_supervisor import ConnectionSupervisor
+
 # The device connection string to authenticate the device with your IoT hub.
 # Using the Azure CLI:
 # az iot hub device-identity show-connection-string --hub-name {YourIoTHubName} --device-id MyNodeDevice --output table
@@ -23,121 +38,552 @@ DPS_ID_SCOPE = ""
 DPS_REGISTRATION_ID = ""
 DPS_REGISTRATION_KEY = ""
 DPS_GLOBAL_SERVICE_ENDPOINT = "global.azure-devices-provisioning.net"
-
-# Define the JSON message to send to IoT Hub.
+# The assigned hub is cached, so a restart connects directly. Start with --reprovision to register with DPS again.
+REGISTRATION_CACHE_FILE = 'registration_cache.json'
+# A registration is delayed by a random time of up to DPS_REGISTRATION_SPREAD seconds, so a fleet that restarts
+# at the same time does not register at once; failed registrations are retried with exponential backoff and jitter.
+DPS_REGISTRATION_SPREAD = 5
+DPS_REGISTRATION_RETRIES = 5
+DPS_RETRY_BASE_DELAY = 2
+DPS_RETRY_MAX_DELAY = 120
+
+# Base values of the simulated readings sent to IoT Hub.
 TEMPERATURE = 21.0
 HUMIDITY = 45
-MSG_TXT = '{{"temperature": {temperature},"humidity": {humidity}}}'
 
 INTERVAL = 1
+TEMPERATURE_ALERT_THRESHOLD = 30
 JSON_FILE = 'config.json'
-
-
-def iothub_client_init():
-    # Create an IoT Hub client
-    client = IoTHubDeviceClient.create_from_connection_string(CONNECTION_STRING)
+# Parameters in config.json, changed with the ChangeParameter method or the desired properties of the device twin.
+# Besides the sample parameters (color, size), the telemetry loop picks up:
+#   telemetryInterval          seconds between two readings (also set by SetTelemetryInterval)
+#   temperatureAlertThreshold  temperature above which temperatureAlert is set
+#   payloadFields              names of parameters that are added to every reading, e.g. ["color"]
+#                              (a list of names, not one of READING_FIELDS)
+CONFIG_STORE = None
+PAYLOAD_PARAMETERS = {}
+# fields of every reading, they cannot be replaced by payload parameters
+READING_FIELDS = ("temperature", "humidity", "timestamp")
+
+# Sender pipeline: number of messages sent concurrently, and how many readings are packed into one message.
+# A batch is flushed when it reaches BATCH_MAX_COUNT readings, BATCH_MAX_BYTES or BATCH_MAX_AGE seconds.
+MAX_IN_FLIGHT = 4
+BATCH_MAX_COUNT = 1
+BATCH_MAX_BYTES = MAX_MESSAGE_BYTES
+BATCH_MAX_AGE = 5
+
+# Store-and-forward: readings that cannot be sent are buffered on disk (oldest are evicted when full)
+# and replayed in batches of up to REPLAY_BATCH_COUNT readings once the device is connected again.
+OFFLINE_QUEUE_FILE = 'offline_queue.db'
+OFFLINE_QUEUE_MAX_ENTRIES = 100000
+REPLAY_BATCH_COUNT = 500
+REPLAY_IDLE_INTERVAL = 1
+
+# Payload encoding of the telemetry: json, msgpack, cbor or struct (see payload_encoding.py).
+# The binary encodings need less bytes on the wire; content type and the schema (struct) are set as message properties.
+PAYLOAD_ENCODING = "json"
+PAYLOAD_FIELDS = ("temperature", "humidity")
+ENCODER = create_encoder(PAYLOAD_ENCODING, PAYLOAD_FIELDS)
+
+# File upload: blocks of UPLOAD_BLOCK_SIZE bytes are uploaded in parallel. The staged blocks are checkpointed
+# in UPLOAD_CHECKPOINT_DIR, so a failed upload is retried (and a restarted one resumed) without sending them again.
+UPLOAD_BLOCK_SIZE = 4 * 1024 * 1024
+UPLOAD_MAX_CONCURRENCY = 4
+UPLOAD_CHECKPOINT_DIR = 'upload_checkpoints'
+UPLOAD_RETRIES = 3
+UPLOAD_RETRY_DELAY = 5
+# status of the upload jobs by job id; finished jobs can be queried for UPLOAD_JOB_RETENTION seconds,
+# at most UPLOAD_MAX_FINISHED_JOBS of them are kept
+UPLOAD_JOBS = {}
+UPLOAD_JOB_RETENTION = 3600
+UPLOAD_MAX_FINISHED_JOBS = 100
+
+# Metrics (send latency, queue depth, messages/bytes per second, method durations, see metrics.py) are sent as the
+# reported property "metrics" every METRICS_REPORT_INTERVAL seconds, and served in the Prometheus text format on
+# http://METRICS_HOST:METRICS_PORT/metrics when METRICS_PORT is set (e.g. 9100; None, the default, disables the endpoint).
+# Every message carries its creation time in the custom property creationTimeMs, so the consumers can compute the lag.
+METRICS = Metrics("iotdevice_")
+METRICS_REPORT_INTERVAL = 60
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None
+METRICS.describe("send_latency_seconds", "Time from sending a message until IoT Hub acknowledged it")
+METRICS.describe("messages_sent_total", "Messages acknowledged by IoT Hub")
+METRICS.describe("bytes_sent_total", "Size of the bodies of the messages acknowledged by IoT Hub")
+METRICS.describe("send_failures_total", "Messages that could not be sent")
+METRICS.describe("method_duration_seconds", "Time from receiving a direct method request until the response was sent", "method")
+METRICS.describe("cloud_service_round_trip_seconds", "Time from sending a cloud service request until its response arrived")
+METRICS.describe("cloud_service_timeouts_total", "Cloud service requests without response within CLOUD_SERVICE_TIMEOUT")
+
+# Cloud service requests (see Scenario/DeviceCallsCloudService): every request carries a request id, which the cloud service
+# passes back with its response in the TriggerDeviceToCloudServiceResponse method. Up to CLOUD_SERVICE_MAX_OUTSTANDING
+# requests can wait for their response at the same time, a request fails without response within CLOUD_SERVICE_TIMEOUT seconds.
+CLOUD_SERVICE_TIMEOUT = 30
+CLOUD_SERVICE_MAX_OUTSTANDING = 100
+CLOUD_SERVICE = None
+
+# Connection supervision (see connection_supervisor.py): a lost connection is re-established, and failed sends are retried
+# up to SEND_MAX_ATTEMPTS times, after a random delay of up to the exponential backoff (RECONNECT_BASE_DELAY doubled per
+# attempt, at most RECONNECT_MAX_DELAY seconds), so a fleet does not reconnect in lockstep. While disconnected, readings
+# go to the offline queue; once connected again it is drained with at most DRAIN_RATE messages per second.
+RECONNECT_BASE_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+SEND_MAX_ATTEMPTS = 4
+DRAIN_RATE = 5
+
+
+def iothub_client_init(connection_string):
+    # Create an IoT Hub client. The SDK's own reconnect (a fixed interval for the whole fleet) and the automatic connect
+    # on send are turned off: only the connection supervisor reconnects, after a backoff with jitter.
+    client = IoTHubDeviceClient.create_from_connection_string(connection_string, connection_retry=False, auto_connect=False)
     return client
 
 
-def provisioning_client_init():
-    client = ProvisioningDeviceClient.create_from_symmetric_key(DPS_GLOBAL_SERVICE_ENDPOINT, DPS_REGISTRATION_ID, DPS_ID_SCOPE, DPS_REGISTRATION_KEY)
-    registrationResult = client.register()
-    return 'HostName=' + registrationResult.registration_state.assigned_hub + ';DeviceId=' + DPS_REGISTRATION_ID + ';SharedAccessKey=' + DPS_REGISTRATION_KEY
-
-
-def device_method_listener(device_client):
-    global INTERVAL
-    while True:
-        method_request = device_client.receive_method_request()
-        print("\nMethod callback called with:\nmethodName = {method_name}\npayload = {payload}".format(method_name=method_request.name, payload=method_request.payload))
-        if method_request.name == "SetTelemetryInterval":
-            try:
-                INTERVAL = int(method_request.payload)
-            except ValueError:
-                response_payload = {"Response": "Invalid parameter"}
-                response_status = 400
-            else:
-                response_payload = {"Response": "Executed direct method {}".format(method_request.name)}
-                response_status = 200
-        elif method_request.name == "UploadFile":
-            try:
-                filename = method_request.payload
-                response_status, response_payload = asyncio.run(upload_blob(device_client, filename))
-            except ValueError:
-                response_payload = {"Response": "Invalid filename passed as body"}
-        elif method_request.name == "ChangeParameter":
-            try:
-                # parameter = json.loads(method_request.payload)
-                parameter = method_request.payload
-                response_status, response_payload = asyncio.run(change_parameter(device_client, parameter))
-            except ValueError:
-                response_status = 400
-                response_payload = {"Response": "Invalid parameter passed as body"}
-        elif method_request.name == "TriggerDeviceToCloudServiceRequest":
-            response_status, response_payload = asyncio.run(trigger_device_cloudservice_request(device_client))
-        elif method_request.name == "TriggerDeviceToCloudServiceResponse":
-            response_status = 200
-            response_payload = method_request.payload
+async def provisioning_client_init():
+    # Register with DPS, returns the assigned hub and the device id
+    await asyncio.sleep(random.uniform(0, DPS_REGISTRATION_SPREAD))
+    for attempt in range(DPS_REGISTRATION_RETRIES + 1):
+        client = ProvisioningDeviceClient.create_from_symmetric_key(DPS_GLOBAL_SERVICE_ENDPOINT, DPS_REGISTRATION_ID, DPS_ID_SCOPE, DPS_REGISTRATION_KEY)
+        try:
+            registrationResult = await client.register()
+            if registrationResult.status == "assigned":
+                return registrationResult.registration_state.assigned_hub, registrationResult.registration_state.device_id
+            error = "registration status {}".format(registrationResult.status)
+        except Exception as ex:
+            error = ex
+
+        if attempt == DPS_REGISTRATION_RETRIES:
+            raise RuntimeError("DPS registration failed: {}".format(error))
+        # full jitter: a random delay of up to the exponential backoff
+        delay = random.uniform(0, min(DPS_RETRY_MAX_DELAY, DPS_RETRY_BASE_DELAY * 2 ** attempt))
+        print("DPS registration failed ({}), retrying in {:.1f} s".format(error, delay))
+        await asyncio.sleep(delay)
+
+
+def create_connection_string(assigned_hub, device_id):
+    return 'HostName=' + assigned_hub + ';DeviceId=' + device_id + ';SharedAccessKey=' + DPS_REGISTRATION_KEY
+
+
+def create_supervisor(client):
+    return ConnectionSupervisor(client, RECONNECT_BASE_DELAY, RECONNECT_MAX_DELAY, SEND_MAX_ATTEMPTS, DRAIN_RATE,
+                                fatal_errors=(ValueError, TypeError, CredentialError))
+
+
+async def connect_client(reprovision=False):
+    # Returns the connection supervisor of the connected client (supervisor.client). Every connect is retried with
+    # backoff and jitter, only a CredentialError is raised at once.
+    # Connect directly to IoT Hub
+    if CONNECTION_STRING != '':
+        supervisor = create_supervisor(iothub_client_init(CONNECTION_STRING))
+        await supervisor.connect()
+        return supervisor
+
+    # use DPS to get the IoT Hub ConnectionString, unless the registration is cached
+    cache = RegistrationCache(REGISTRATION_CACHE_FILE, DPS_ID_SCOPE, DPS_REGISTRATION_ID, DPS_REGISTRATION_KEY)
+    if reprovision:
+        cache.clear()
+    cached = cache.load()
+    if cached is not None:
+        assigned_hub, device_id = cached
+        print("Using cached DPS registration, assigned hub: {}".format(assigned_hub))
+        supervisor = create_supervisor(iothub_client_init(create_connection_string(assigned_hub, device_id)))
+        try:
+            await supervisor.connect()
+            return supervisor
+        except CredentialError as ex:
+            # e.g. the device has been moved to another hub
+            print("Connecting with the cached registration failed, registering with DPS again: {}".format(ex))
+            await supervisor.client.shutdown()
+            cache.clear()
+
+    assigned_hub, device_id = await provisioning_client_init()
+    cache.save(assigned_hub, device_id)
+    supervisor = create_supervisor(iothub_client_init(create_connection_string(assigned_hub, device_id)))
+    await supervisor.connect()
+    return supervisor
+
+
+def create_method_request_handler(device_client, loop):
+    # The SDK invokes handlers on its own internal event loop. Hand every request over to the
+    # application loop, so the sample state (INTERVAL, ...) is only ever touched from one loop.
+    async def method_request_handler(method_request):
+        future = asyncio.run_coroutine_threadsafe(handle_method_request(device_client, method_request), loop)
+        await asyncio.wrap_future(future)
+
+    return method_request_handler
+
+
+async def handle_method_request(device_client, method_request):
+    started = time.perf_counter()
+    print("\nMethod callback called with:\nmethodName = {method_name}\npayload = {payload}".format(method_name=method_request.name, payload=method_request.payload))
+    if method_request.name == "SetTelemetryInterval":
+        try:
+            parameters = {"telemetryInterval": float(method_request.payload)}
+            check_parameters(parameters)
+            CONFIG_STORE.update(parameters)
+        except (TypeError, ValueError):
+            response_payload = {"Response": "Invalid parameter"}
+            response_status = 400
         else:
-            response_payload = {
-                "Response": "Direct method {} not defined".format(method_request.name)}
+            response_payload = {"Response": "Executed direct method {}".format(method_request.name)}
+            response_status = 200
+    elif method_request.name == "UploadFile":
+        try:
+            filename = method_request.payload
+            response_status, response_payload = await upload_blob(device_client, filename)
+        except (TypeError, ValueError):
+            response_status = 400
+            response_payload = {"Response": "Invalid filename passed as body"}
+    elif method_request.name == "GetUploadStatus":
+        expire_upload_jobs()
+        job = UPLOAD_JOBS.get(method_request.payload) if isinstance(method_request.payload, str) else None
+        if job is None:
             response_status = 404
+            response_payload = {"Response": "Upload job {} not found".format(method_request.payload)}
+        else:
+            response_status = 200
+            response_payload = dict(job)
+    elif method_request.name == "ChangeParameter":
+        try:
+            # parameter = json.loads(method_request.payload)
+            parameter = method_request.payload
+            response_status, response_payload = await change_parameter(device_client, parameter)
+        except ValueError:
+            response_status = 400
+            response_payload = {"Response": "Invalid parameter passed as body"}
+    elif method_request.name == "TriggerDeviceToCloudServiceRequest":
+        try:
+            # optional payload: the number of requests to send at once, every request is a task of its own
+            count = int(method_request.payload) if method_request.payload is not None else 1
+            if not 1 <= count <= CLOUD_SERVICE_MAX_OUTSTANDING:
+                raise ValueError("count must be between 1 and {}".format(CLOUD_SERVICE_MAX_OUTSTANDING))
+            response_status, response_payload = await trigger_device_cloudservice_request(device_client, count)
+        except (TypeError, ValueError):
+            response_status = 400
+            response_payload = {"Response": "Invalid number of requests passed as body, at most {}".format(CLOUD_SERVICE_MAX_OUTSTANDING)}
+    elif method_request.name == "TriggerDeviceToCloudServiceResponse":
+        response_status = 200
+        response_payload = resolve_cloudservice_responses(method_request.payload)
+    else:
+        response_payload = {
+            "Response": "Direct method {} not defined".format(method_request.name)}
+        response_status = 404
+
+    method_response = MethodResponse.create_from_method_request(method_request, response_status, payload=response_payload)
+    await device_client.send_method_response(method_response)
+    METRICS.observe("method_duration_seconds", time.perf_counter() - started, label=method_request.name)
+
+
+def create_twin_patch_handler(device_client, loop):
+    # Like the method requests, desired property patches are handled on the application loop
+    async def twin_patch_handler(patch):
+        future = asyncio.run_coroutine_threadsafe(apply_desired_properties(device_client, patch), loop)
+        await asyncio.wrap_future(future)
+
+    return twin_patch_handler
+
+
+async def apply_desired_properties(device_client, desired):
+    parameters = {key: value for key, value in desired.items() if not key.startswith("$")}
+    for key in list(parameters):
+        try:
+            check_parameters({key: parameters[key]})
+        except ValueError as ex:
+            print("Desired property ignored: {}".format(ex))
+            del parameters[key]
+    changed = CONFIG_STORE.update(parameters)
+    if changed:
+        print("Parameters changed by the device twin: {}".format(changed))
+        await device_client.patch_twin_reported_properties(changed)
+
+
+def check_parameters(parameters):
+    # Raises ValueError for values the telemetry loop cannot use, so they are rejected before they reach the
+    # configuration store (and config.json). An interval of 0 or below would send readings without pause.
+    for key in ("telemetryInterval", "temperatureAlertThreshold"):
+        if key not in parameters:
+            continue
+        try:
+            value = float(parameters[key])
+        except (TypeError, ValueError):
+            raise ValueError("{} must be a number, not {!r}".format(key, parameters[key]))
+        if not math.isfinite(value):
+            raise ValueError("{} must be a finite number".format(key))
+        if key == "telemetryInterval" and value <= 0:
+            raise ValueError("telemetryInterval must be a positive number of seconds")
+    if "payloadFields" in parameters:
+        fields = parameters["payloadFields"]
+        if not isinstance(fields, list) or not all(isinstance(field, str) for field in fields):
+            raise ValueError("payloadFields must be a list of parameter names, not {!r}".format(fields))
+        clashing = [field for field in fields if field in READING_FIELDS]
+        if clashing:
+            raise ValueError("payloadFields must not contain the reading fields {}".format(clashing))
+
+
+def apply_configuration(changes):
+    # Subscribed to the configuration store, so changes take effect without a restart
+    global INTERVAL, TEMPERATURE_ALERT_THRESHOLD, PAYLOAD_PARAMETERS
+    try:
+        # e.g. an invalid value in a config.json edited by hand
+        check_parameters(changes)
+        if "telemetryInterval" in changes:
+            INTERVAL = float(changes["telemetryInterval"])
+        if "temperatureAlertThreshold" in changes:
+            TEMPERATURE_ALERT_THRESHOLD = float(changes["temperatureAlertThreshold"])
+    except (TypeError, ValueError) as ex:
+        print("Invalid parameter value: {}".format(ex))
+    # the values of the payload parameters may change as well, so they are always collected again
+    fields = CONFIG_STORE.get("payloadFields") or []
+    try:
+        check_parameters({"payloadFields": fields})
+    except ValueError as ex:
+        print("Invalid parameter value: {}".format(ex))
+        fields = []
+    PAYLOAD_PARAMETERS = {field: CONFIG_STORE.get(field) for field in fields}
 
-        method_response = MethodResponse(method_request.request_id, response_status, payload=response_payload)
-        device_client.send_method_response(method_response)
 
+async def main(reprovision=False):
+    global CONFIG_STORE, CLOUD_SERVICE
+    supervisor = await connect_client(reprovision)
+    client = supervisor.client
 
-async def main():
     try:
         print("IoT Hub device sending periodic messages, press Ctrl-C to exit")
 
-        # Start a thread to listen
-        device_method_thread = threading.Thread(target=device_method_listener, args=(client,))
-        device_method_thread.daemon = True
-        device_method_thread.start()
-
-        while True:
-            # Build the message with simulated telemetry values.
-            temperature = TEMPERATURE + (random.random() * 15)
-            humidity = HUMIDITY + (random.random() * 20)
-            msg_txt_formatted = MSG_TXT.format(temperature=temperature, humidity=humidity)
-            message = Message(msg_txt_formatted)
-
-            # Add a custom application property to the message.
-            # An IoT hub can filter on these properties without access to the message body.
-            if temperature > 30:
-                message.custom_properties["temperatureAlert"] = "true"
-            else:
-                message.custom_properties["temperatureAlert"] = "false"
-
-            # Send the message.
-            print("Sending message: {}".format(message))
-            client.send_message(message)
-            print("Message sent")
-            time.sleep(INTERVAL)
+        loop = asyncio.get_running_loop()
+        CONFIG_STORE = ConfigStore(JSON_FILE)
+        CONFIG_STORE.subscribe(apply_configuration)
+        apply_configuration(CONFIG_STORE.values)
+        CLOUD_SERVICE = RequestCorrelator(lambda request_id: send_cloudservice_request(client, request_id), CLOUD_SERVICE_TIMEOUT, CLOUD_SERVICE_MAX_OUTSTANDING)
+
+        # Direct methods are handled by coroutines instead of a dedicated listener thread
+        client.on_method_request_received = create_method_request_handler(client, loop)
+        client.on_twin_desired_properties_patch_received = create_twin_patch_handler(client, loop)
+
+        supervisor.start()
+        twin = await supervisor.call(client.get_twin)
+        await apply_desired_properties(client, twin.get("desired", {}))
+
+        offline_queue = OfflineQueue(OFFLINE_QUEUE_FILE, OFFLINE_QUEUE_MAX_ENTRIES)
+        timed_send = create_timed_send(client)
+
+        async def send_message(message):
+            await supervisor.call(timed_send, message)
+
+        def buffer_readings(readings, ex):
+            print("Sending failed, buffering {} reading(s): {}".format(len(readings), ex))
+            offline_queue.extend(readings)
+
+        sender = TelemetrySender(send_message, create_telemetry_message, max_in_flight=MAX_IN_FLIGHT,
+                                 max_batch_count=BATCH_MAX_COUNT, max_batch_bytes=BATCH_MAX_BYTES, max_batch_age=BATCH_MAX_AGE,
+                                 on_send_failed=buffer_readings, encoder=ENCODER)
+        forwarder = asyncio.ensure_future(forward_offline_readings(supervisor, send_message, offline_queue))
+
+        METRICS.gauge("sender_in_flight", lambda: sender.in_flight)
+        METRICS.gauge("sender_pending_readings", lambda: sender.pending)
+        METRICS.gauge("offline_queue_depth", lambda: len(offline_queue))
+        METRICS.gauge("cloud_service_outstanding", lambda: CLOUD_SERVICE.outstanding)
+        METRICS.gauge("connected", lambda: int(supervisor.connected))
+        METRICS.gauge("reconnects", lambda: supervisor.reconnects)
+        METRICS.gauge("send_retries", lambda: supervisor.retries)
+        reporter = asyncio.ensure_future(report_metrics(client))
+        metrics_server = None
+        try:
+            if METRICS_PORT:
+                try:
+                    metrics_server = await start_metrics_server(METRICS, METRICS_HOST, METRICS_PORT)
+                except OSError as ex:
+                    # e.g. the port is in use, the device runs without the endpoint
+                    print("Metrics endpoint on {}:{} not started: {}".format(METRICS_HOST, METRICS_PORT, ex))
+            while True:
+                # Build a reading with simulated telemetry values, and the time it was taken (milliseconds since the epoch, UTC),
+                # which it keeps in the offline queue
+                reading = {
+                    "temperature": TEMPERATURE + (random.random() * 15),
+                    "humidity": HUMIDITY + (random.random() * 20),
+                    "timestamp": int(time.time() * 1000)
+                }
+                reading.update(PAYLOAD_PARAMETERS)
+
+                # Hand the reading to the sender. It only waits when MAX_IN_FLIGHT messages are unacknowledged,
+                # so the sampling interval is not stretched by the round-trip to IoT Hub.
+                # While the connection is down, readings go straight to the offline queue.
+                # An error is reported and the loop goes on with the next reading.
+                try:
+                    if supervisor.connected:
+                        await sender.add(reading)
+                    else:
+                        offline_queue.append(reading)
+                except Exception as ex:
+                    print("Handling the reading failed: {}".format(ex))
+                await asyncio.sleep(INTERVAL)
+        finally:
+            await sender.stop()
+            await supervisor.stop()
+            forwarder.cancel()
+            reporter.cancel()
+            CLOUD_SERVICE.fail_all(RuntimeError("The device is shutting down"))
+            if metrics_server is not None:
+                metrics_server.close()
+            offline_queue.close()
 
     except Exception as ex:
         print("\nException:")
         print(ex)
 
-    except KeyboardInterrupt:
-        print("\nIoTHubDeviceClient sample stopped")
-
     finally:
-        # Finally, disconnect the client
-        await client.disconnect()
+        # Finally, shut down the client
+        if CONFIG_STORE is not None:
+            CONFIG_STORE.close()
+        await client.shutdown()
+
+
+def create_timed_send(client):
+    # client.send_message, recording the latency until IoT Hub acknowledged the message
+    async def send_message(message):
+        started = time.perf_counter()
+        try:
+            await client.send_message(message)
+        except Exception:
+            METRICS.inc("send_failures_total")
+            raise
+        METRICS.observe("send_latency_seconds", time.perf_counter() - started)
+        METRICS.inc("messages_sent_total")
+        body = message.data
+        METRICS.inc("bytes_sent_total", len(body.encode("utf-8") if isinstance(body, str) else body))
+
+    return send_message
+
+
+async def report_metrics(client):
+    while True:
+        await asyncio.sleep(METRICS_REPORT_INTERVAL)
+        try:
+            report = METRICS.report()
+            print("Metrics: {}".format(report))
+            await client.patch_twin_reported_properties({"metrics": report})
+        except Exception as ex:
+            print("Reporting the metrics failed: {}".format(ex))
+
+
+async def forward_offline_readings(supervisor, send_message, offline_queue):
+    # Drain the offline queue oldest-first. Several readings are packed into one message, so a long
+    # backlog is caught up with few round-trips. Readings are only removed once IoT Hub acknowledged them.
+    # Replaying waits while the device is disconnected, and is paced to DRAIN_RATE messages per second.
+    while True:
+        await supervisor.wait_connected()
+        ids, bodies = offline_queue.peek(REPLAY_BATCH_COUNT)
+        if not ids:
+            await asyncio.sleep(REPLAY_IDLE_INTERVAL)
+            continue
+        await supervisor.pace()
+
+        readings = []
+        encoded = []
+        size = ENCODER.batch_overhead
+        for body in bodies:
+            reading = json.loads(body)
+            item = ENCODER.encode(reading)
+            size += len(item) + ENCODER.item_overhead
+            if encoded and size > BATCH_MAX_BYTES:
+                break
+            readings.append(reading)
+            encoded.append(item)
+        count = len(encoded)
+
+        message = create_telemetry_message(ENCODER.join(encoded), readings)
+        try:
+            await send_message(message)
+        except Exception as ex:
+            print("Replaying buffered readings failed: {}".format(ex))
+            await asyncio.sleep(REPLAY_IDLE_INTERVAL)
+        else:
+            offline_queue.remove(ids[count - 1])
+            print("Replayed {} buffered reading(s)".format(count))
 
 
-async def upload_blob(device_client, filename):
-    blob_name = os.path.basename(filename)
-    storage_info = device_client.get_storage_info_for_blob(blob_name)
-    success, result = await store_blob(storage_info, filename)
+def create_telemetry_message(body, readings):
+    message = Message(body)
+    # the creation time is the time of the oldest reading, so the lag of replayed readings includes the time they were buffered
+    timestamps = [reading["timestamp"] for reading in readings if "timestamp" in reading]
+    message.custom_properties[CREATION_TIME_PROPERTY] = str(min(timestamps)) if timestamps else creation_timestamp()
+    message.content_type = ENCODER.content_type
+    if ENCODER.content_encoding is not None:
+        message.content_encoding = ENCODER.content_encoding
+    for name, value in ENCODER.properties.items():
+        message.custom_properties[name] = value
+
+    # Add a custom application property to the message.
+    # An IoT hub can filter on these properties without access to the message body.
+    # For a batch, the alert is raised if any of the readings is above the threshold.
+    if any(reading["temperature"] > TEMPERATURE_ALERT_THRESHOLD for reading in readings):
+        message.custom_properties["temperatureAlert"] = "true"
+    else:
+        message.custom_properties["temperatureAlert"] = "false"
 
-    response = {"Response": blob_name}
-    return (200 if success else 400, response)
+    print("Sending message: {}".format(message))
+    return message
 
 
-async def store_blob(blob_info, file_name):
+async def upload_blob(device_client, filename):
+    # The upload runs in the background, the method returns right away with the id of the upload job.
+    # The progress can be queried with the GetUploadStatus method.
+    blob_name = os.path.basename(filename)
+    if not blob_name:
+        raise ValueError("Invalid filename")
+    expire_upload_jobs()
+    # a second job for the same blob would stage the same blocks and overwrite the same checkpoint file
+    running = next((job for job in UPLOAD_JOBS.values() if job["blobName"] == blob_name and job["status"] == "running"), None)
+    if running is not None:
+        return (409, {"Response": "An upload of {} is already running".format(blob_name), "jobId": running["jobId"]})
+    job_id = str(uuid.uuid4())
+    UPLOAD_JOBS[job_id] = {"jobId": job_id, "file": filename, "blobName": blob_name, "status": "running", "uploadedBytes": 0, "totalBytes": None}
+    asyncio.ensure_future(run_upload_job(device_client, UPLOAD_JOBS[job_id]))
+
+    response = {"Response": blob_name, "jobId": job_id}
+    return (202, response)
+
+
+async def run_upload_job(device_client, job):
+    for attempt in range(UPLOAD_RETRIES + 1):
+        try:
+            # every attempt gets a new SAS token; the blocks staged by earlier attempts are kept
+            storage_info = await device_client.get_storage_info_for_blob(job["blobName"])
+            success, result = await store_blob(storage_info, job["file"], job)
+            status_code = 200 if success else getattr(result, "status_code", 500)
+            await device_client.notify_blob_upload_status(storage_info["correlationId"], success, status_code, str(result))
+        except Exception as ex:
+            success, result, status_code = False, ex, 500
+
+        if success:
+            job["status"] = "succeeded"
+            job["finishedAt"] = time.time()
+            print("Upload job {} of {} succeeded".format(job["jobId"], job["file"]))
+            return
+
+        job["error"] = str(result)
+        print("Upload job {} of {} failed (attempt {}): {}".format(job["jobId"], job["file"], attempt + 1, result))
+        if status_code == 404 or attempt == UPLOAD_RETRIES:
+            break
+        await asyncio.sleep(UPLOAD_RETRY_DELAY * 2 ** attempt)
+    job["status"] = "failed"
+    job["finishedAt"] = time.time()
+
+
+def expire_upload_jobs():
+    now = time.time()
+    finished = sorted((job for job in UPLOAD_JOBS.values() if job["status"] != "running"), key=lambda job: job["finishedAt"])
+    for index, job in enumerate(finished):
+        if now - job["finishedAt"] > UPLOAD_JOB_RETENTION or index < len(finished) - UPLOAD_MAX_FINISHED_JOBS:
+            del UPLOAD_JOBS[job["jobId"]]
+
+
+async def store_blob(blob_info, file_name, job):
+    # The storage SDK is synchronous; run the upload in the default executor to keep the loop responsive
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, upload_file_to_blob, blob_info, file_name, job)
+
+
+def upload_file_to_blob(blob_info, file_name, job):
     try:
         sas_url = "https://{}/{}/{}{}".format(
             blob_info["hostName"],
@@ -148,11 +594,20 @@ async def store_blob(blob_info, file_name):
 
         print("\nUploading file: {} to Azure Storage as blob: {} in container {}\n".format(file_name, blob_info["blobName"], blob_info["containerName"]))
 
+        def progress(uploaded, total):
+            # called from the upload threads after every block
+            job["uploadedBytes"] = uploaded
+            job["totalBytes"] = total
+            print("Upload job {}: {} of {} bytes".format(job["jobId"], uploaded, total))
+
+        os.makedirs(UPLOAD_CHECKPOINT_DIR, exist_ok=True)
+        checkpoint_file = os.path.join(UPLOAD_CHECKPOINT_DIR, blob_info["blobName"].replace("/", "_") + ".json")
+
         # Upload the specified file
         with BlobClient.from_blob_url(sas_url) as blob_client:
-            with open(file_name, "rb") as f:
-                result = blob_client.upload_blob(f, overwrite=True)
-                return (True, result)
+            uploader = BlobUploader(blob_client, file_name, checkpoint_file, UPLOAD_BLOCK_SIZE, UPLOAD_MAX_CONCURRENCY, progress)
+            result = uploader.upload()
+            return (True, result)
 
     except FileNotFoundError as ex:
         # catch file not found and add an HTTP status code to return in notification to IoT Hub
@@ -165,38 +620,63 @@ async def store_blob(blob_info, file_name):
 
 
 async def change_parameter(device_client, parameter):
-    with open(JSON_FILE, 'r') as infile:
-        filecontent = json.load(infile)
-    infile.close()
-
-    # filecontent[parameter]=
+    # The parameters are changed in memory right away, the configuration store writes config.json shortly after
+    if not isinstance(parameter, dict):
+        raise ValueError("The parameters must be a JSON object")
     for key in parameter:
         print(key, parameter[key])
-        filecontent[key] = parameter[key]
-
-    with open(JSON_FILE, 'w') as outfile:
-        json.dump(filecontent, outfile)
-    outfile.close()
+    check_parameters(parameter)
+    CONFIG_STORE.update(parameter)
 
     response = {"Response": "OK"}
     return (200, response)
 
 
-async def trigger_device_cloudservice_request(device_client):
-    message = Message("{\"TriggerCloudService\":true}")
+async def trigger_device_cloudservice_request(device_client, count=1):
+    # The requests run in the background, the responses arrive with the TriggerDeviceToCloudServiceResponse method
+    for _ in range(count):
+        asyncio.ensure_future(call_cloudservice())
+
+    return (202, "Cloud service has been triggered with {} request(s)".format(count))
+
+
+async def call_cloudservice():
+    # Sends a request and waits for its response; returns the response, or None if the request failed
+    try:
+        response, seconds = await CLOUD_SERVICE.request()
+    except asyncio.TimeoutError as ex:
+        METRICS.inc("cloud_service_timeouts_total")
+        print(ex)
+        return None
+    except Exception as ex:
+        print("Cloud service request failed: {}".format(ex))
+        return None
+    METRICS.observe("cloud_service_round_trip_seconds", seconds)
+    print("Cloud service responded after {:.0f} ms: {}".format(seconds * 1000, response))
+    return response
+
+
+async def send_cloudservice_request(device_client, request_id):
+    message = Message(json.dumps({"TriggerCloudService": True, "requestId": request_id}))
     message.custom_properties["TriggerCloudService"] = "true"
-    device_client.send_message(message)
+    message.custom_properties["requestId"] = request_id
+    message.custom_properties[CREATION_TIME_PROPERTY] = creation_timestamp()
+    await device_client.send_message(message)
+
 
-    return (200, "Cloud service has been triggered")
+def resolve_cloudservice_responses(payload):
+    # The cloud service passes back the ids of the requests it answered with {"requestIds": [...], "response": ...}.
+    # Any other payload (a cloud service without request ids) is returned as is, like before.
+    if not isinstance(payload, dict) or not isinstance(payload.get("requestIds"), list):
+        return payload
+    resolved = sum(1 for request_id in payload["requestIds"] if CLOUD_SERVICE.resolve(request_id, payload.get("response")))
+    return {"resolved": resolved, "unknown": len(payload["requestIds"]) - resolved}
 
 if __name__ == '__main__':
     print("IoT Hub Quickstart - Simulated device with method listener and file upload")
     print("Press Ctrl-C to exit")
 
-    # use DPS to get the IoT Hub ConnectionString
-    if CONNECTION_STRING == '':
-        CONNECTION_STRING = provisioning_client_init()
-
-    client = iothub_client_init()
-
-    asyncio.run(main())
+    try:
+        asyncio.run(main(reprovision="--reprovision" in sys.argv))
+    except KeyboardInterrupt:
+        print("\nIoTHubDeviceClient sample stopped")
@@ -0,0 +1,125 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for full license information.
+
+# Resumable block upload of a file to Azure Blob Storage.
+# The file is split into blocks of block_size bytes, which are staged in parallel (at most max_concurrency
+# at a time) and committed with one block list at the end. The indexes of the staged blocks are persisted
+# in a checkpoint file, so an upload that was interrupted (e.g. by a disconnect) skips the blocks that were
+# already staged. Uncommitted blocks are kept by the storage service for 7 days.
+#
+# blob_client needs stage_block(), commit_block_list() and get_block_list(), like azure.storage.blob.BlobClient
+# or a local stand-in for tests.
+import base64
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_MAX_CONCURRENCY = 4
+
+
+class BlobUploader:
+
+    def __init__(self, blob_client, file_name, checkpoint_file, block_size=DEFAULT_BLOCK_SIZE, max_concurrency=DEFAULT_MAX_CONCURRENCY, progress=None):
+        if block_size < 1 or max_concurrency < 1:
+            raise ValueError("block_size and max_concurrency must be at least 1")
+        # progress(uploaded_bytes, total_bytes) is called from worker threads after every staged block
+        self.blob_client = blob_client
+        self.file_name = file_name
+        self.checkpoint_file = checkpoint_file
+        self.block_size = block_size
+        self.max_concurrency = max_concurrency
+        self.progress = progress
+        self._lock = threading.Lock()
+
+    def upload(self):
+        # raises FileNotFoundError if the file does not exist; storage errors are raised as they are
+        stat = os.stat(self.file_name)
+        size = stat.st_size
+        block_count = max((size + self.block_size - 1) // self.block_size, 1)
+        block_ids = [_block_id(index) for index in range(block_count)]
+
+        staged = self._load_checkpoint(stat)
+        uploaded = sum(self._block_length(index, size) for index in staged)
+        self._report(uploaded, size)
+
+        pending = [index for index in range(block_count) if index not in staged]
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor, open(self.file_name, "rb") as f:
+            in_flight = set()
+            for index in pending:
+                # bound the number of blocks held in memory to the number of parallel uploads
+                if len(in_flight) >= self.max_concurrency:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        uploaded += future.result()
+                        self._report(uploaded, size)
+                f.seek(index * self.block_size)
+                data = f.read(self.block_size)
+                in_flight.add(executor.submit(self._stage, index, block_ids[index], data, staged, stat))
+            for future in wait(in_flight).done:
+                uploaded += future.result()
+            self._report(uploaded, size)
+
+        self.blob_client.commit_block_list(block_ids)
+        self._remove_checkpoint()
+        return size
+
+    def _stage(self, index, block_id, data, staged, stat):
+        self.blob_client.stage_block(block_id, data, length=len(data))
+        with self._lock:
+            staged.add(index)
+            self._save_checkpoint(stat, staged)
+        return len(data)
+
+    def _block_length(self, index, size):
+        return min(self.block_size, size - index * self.block_size)
+
+    def _report(self, uploaded, size):
+        if self.progress is not None:
+            self.progress(uploaded, size)
+
+    def _load_checkpoint(self, stat):
+        try:
+            with open(self.checkpoint_file, "r") as f:
+                checkpoint = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return set()
+
+        # start over, if the file changed since the checkpoint was written
+        if checkpoint.get("size") != stat.st_size or checkpoint.get("mtime") != stat.st_mtime or checkpoint.get("blockSize") != self.block_size:
+            return set()
+
+        # only trust blocks the storage service still has as uncommitted blocks
+        try:
+            _, uncommitted = self.blob_client.get_block_list(block_list_type="uncommitted")
+            available = {block.id for block in uncommitted}
+        except Exception as ex:
+            print("Could not verify the staged blocks, starting over: {}".format(ex))
+            return set()
+        return {index for index in checkpoint.get("staged", []) if _block_id(index) in available}
+
+    def _save_checkpoint(self, stat, staged):
+        checkpoint = {
+            "file": self.file_name,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "blockSize": self.block_size,
+            "staged": sorted(staged)
+        }
+        # write-rename, so a crash never leaves a truncated checkpoint behind
+        temp_file = self.checkpoint_file + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(temp_file, self.checkpoint_file)
+
+    def _remove_checkpoint(self):
+        try:
+            os.remove(self.checkpoint_file)
+        except FileNotFoundError:
+            pass
+
+
+def _block_id(index):
+    # block ids must be base64 and of the same length for all blocks of a blob
+    return base64.b64encode("{:08d}".format(index).encode("utf-8")).decode("utf-8")
@@ -0,0 +1,83 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for full license information.
+import asyncio
+import json
+import os
+
+
+class ConfigStore:
+    # In-memory configuration, loaded once from a JSON file.
+    # update() changes the values right away and notifies the subscribers; the file is written later:
+    # changes within flush_delay seconds are coalesced into one write, but a write is never postponed
+    # for more than max_flush_delay seconds. The file is replaced atomically (write to a temporary
+    # file, then rename), so a crash leaves either the old or the new configuration behind.
+    # All methods must be called from the event loop the store was created on.
+
+    def __init__(self, path, flush_delay=1.0, max_flush_delay=10.0):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.max_flush_delay = max_flush_delay
+        self._loop = asyncio.get_running_loop()
+        self._subscribers = []
+        self._flush_timer = None
+        self._first_change = None
+        try:
+            with open(path, "r") as f:
+                self._values = json.load(f)
+        except FileNotFoundError:
+            self._values = {}
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    @property
+    def values(self):
+        return dict(self._values)
+
+    def subscribe(self, callback):
+        # callback(changes) is called with a dict of the changed keys and their new values
+        self._subscribers.append(callback)
+
+    def update(self, changes):
+        changed = {key: value for key, value in changes.items() if self._values.get(key, object()) != value}
+        if not changed:
+            return changed
+        self._values.update(changed)
+        for callback in self._subscribers:
+            callback(changed)
+        self._schedule_flush()
+        return changed
+
+    def flush(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        self._first_change = None
+
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self._values, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def close(self):
+        # write pending changes
+        if self._flush_timer is not None:
+            self.flush()
+
+    def _schedule_flush(self):
+        now = self._loop.time()
+        if self._first_change is None:
+            self._first_change = now
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+        delay = min(self.flush_delay, self._first_change + self.max_flush_delay - now)
+        self._flush_timer = self._loop.call_later(max(delay, 0), self._flush_on_timer)
+
+    def _flush_on_timer(self):
+        self._flush_timer = None
+        try:
+            self.flush()
+        except OSError as ex:
+            print("Writing the configuration to {} failed: {}".format(self.path, ex))
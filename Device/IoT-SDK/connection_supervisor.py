@@ -0,0 +1,159 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for full license information.
+
+# Connection supervisor for an IoT Hub client (IoTHubDeviceClient or IoTHubModuleClient, aio).
+# During an incident of the hub a whole fleet loses the connection at the same time. Reconnects and retries at
+# fixed intervals would hit the hub in lockstep, so every delay is a random time of up to the exponential backoff
+# (full jitter), and a backlog is drained at a limited rate once the connection is back.
+#   await supervisor.connect()              the first connect, retried like a reconnect
+#   await supervisor.wait_connected()       producers pause here while the client is disconnected
+#   await supervisor.call(operation, *args)  runs a coroutine function, e.g. client.send_message, with retries
+#   await supervisor.pace()                 limits the drain of a backlog to drain_rate calls per second
+# start() tracks the connection state in a task and reconnects the client, stop() ends it. Use it from the event loop.
+# Create the client with connection_retry=False (azure-iot-device 2.6.0+): otherwise the SDK reconnects on its own fixed
+# timer, and connect() only waits for that reconnect.
+import asyncio
+import random
+
+
+class ConnectionSupervisor:
+
+    def __init__(self, client, base_delay=1.0, max_delay=60.0, max_attempts=5, drain_rate=5.0, poll_interval=1.0,
+                 fatal_errors=(ValueError, TypeError), on_state_change=None):
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+        self.client = client
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        # calls per second of pace(), None or 0 for no limit
+        self.drain_rate = drain_rate
+        self.poll_interval = poll_interval
+        # errors that are not retried, e.g. a message that is too large or invalid credentials
+        self.fatal_errors = fatal_errors
+        # on_state_change(connected) is called when the connection is lost or back
+        self.on_state_change = on_state_change
+        self.reconnects = 0
+        self.retries = 0
+        self._connected = asyncio.Event()
+        if client.connected:
+            self._connected.set()
+        self._next_slot = 0.0
+        self._task = None
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    def backoff(self, attempt):
+        # full jitter: a random delay of up to the exponential backoff of the attempt (0, 1, ...)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._supervise())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def connect(self):
+        # Connects the client, failed attempts are retried after a backoff with jitter, so a fleet that restarts during an
+        # incident of the hub does not exit (and get restarted by its process manager) in lockstep. Errors in fatal_errors,
+        # e.g. invalid credentials, are raised at once.
+        attempt = 0
+        while True:
+            try:
+                await self.client.connect()
+                self._set_state(True)
+                return
+            except asyncio.CancelledError:
+                raise
+            except self.fatal_errors:
+                raise
+            except Exception as ex:
+                delay = self.backoff(attempt)
+                attempt += 1
+                print("Connecting failed ({}), retrying in {:.1f} s".format(ex, delay))
+                await asyncio.sleep(delay)
+
+    async def wait_connected(self, timeout=None):
+        # raises asyncio.TimeoutError if the client is not connected within timeout seconds
+        if not self._connected.is_set():
+            await asyncio.wait_for(self._connected.wait(), timeout)
+
+    async def call(self, operation, *args):
+        # Returns the result of operation(*args). Failed calls are retried after a backoff with jitter, up to max_attempts
+        # calls; while the client is disconnected, every attempt waits up to max_delay seconds for the connection first.
+        # The last error is raised, errors in fatal_errors at once.
+        attempt = 0
+        while True:
+            try:
+                await self.wait_connected(self.max_delay)
+                return await operation(*args)
+            except asyncio.CancelledError:
+                raise
+            except self.fatal_errors:
+                raise
+            except Exception:
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    raise
+                self.retries += 1
+                if not self.client.connected:
+                    self._set_state(False)
+                await asyncio.sleep(self.backoff(attempt - 1))
+
+    async def pace(self):
+        # waits for the next of the evenly spaced slots, drain_rate per second; a slot not taken is not saved up,
+        # so there is no burst after an idle time
+        if not self.drain_rate:
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        wait = self._next_slot - now
+        self._next_slot = max(self._next_slot, now) + 1.0 / self.drain_rate
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def _supervise(self):
+        attempt = 0
+        while True:
+            if self.client.connected:
+                self._set_state(True)
+                attempt = 0
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            self._set_state(False)
+            delay = self.backoff(attempt)
+            attempt += 1
+            print("Disconnected, reconnecting in {:.1f} s".format(delay))
+            await asyncio.sleep(delay)
+            if self.client.connected:
+                # connected in the meantime, e.g. by a connect() of the application
+                continue
+            try:
+                await self.client.connect()
+                self.reconnects += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                print("Reconnecting failed: {}".format(ex))
+
+    def _set_state(self, connected):
+        if connected == self._connected.is_set():
+            return
+        if connected:
+            self._connected.set()
+            print("Connected")
+        else:
+            self._connected.clear()
+            print("Connection lost")
+        if self.on_state_change is not None:
+            self.on_state_change(connected)
@@ -0,0 +1,292 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for full license information.
+
+# Fleet simulator: runs many simulated devices (the same simulated readings as IotDevice.py) on one
+# asyncio event loop per process, to capacity-test IoT Hub, a broker and the downstream functions.
+# Every device has its own identity: the device ids are <prefix>-<index> and, with a group key,
+# the device keys are derived like for a DPS group enrollment (see Provisioning/GroupEnrollmentFunction).
+# The achieved messages/s and the latency from publish to acknowledgement (PUBACK) are reported.
+#
+# Against a local MQTT broker (or the built-in stand-in broker):
+#   python fleet_simulator.py --stand-in-broker --devices 2000 --rate 2 --duration 30
+#   python fleet_simulator.py --host localhost --port 1883 --devices 5000 --processes 4
+# Against IoT Hub (the devices must exist, e.g. registered through the group enrollment):
+#   python fleet_simulator.py --hub myhub.azure-devices.net --group-key <key> --devices 100
+import argparse
+import base64
+import hashlib
+import hmac
+import math
+import multiprocessing
+import os
+import random
+import ssl
+import time
+import urllib.parse
+import asyncio
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from mqtt_client import MqttClient, run_stand_in_broker
+from payload_encoding import create_encoder
+
+# Base values of the simulated readings, as in IotDevice.py
+TEMPERATURE = 21.0
+HUMIDITY = 45
+IOTHUB_API_VERSION = "2021-04-12"
+# number of latencies kept per process for the final percentiles
+LATENCY_SAMPLES = 200000
+
+
+def derive_device_key(device_id, group_key):
+    # Same derivation as get_derived_device_key in the GroupEnrollmentFunction
+    return base64.b64encode(hmac.new(base64.b64decode(group_key), device_id.encode("utf-8"), hashlib.sha256).digest()).decode("utf-8")
+
+
+def generate_sas_token(resource_uri, key, ttl=3600):
+    expiry = int(time.time() + ttl)
+    encoded_uri = urllib.parse.quote(resource_uri, safe="")
+    signature = base64.b64encode(hmac.new(base64.b64decode(key), "{}\n{}".format(encoded_uri, expiry).encode("utf-8"), hashlib.sha256).digest())
+    return "SharedAccessSignature sr={}&sig={}&se={}".format(encoded_uri, urllib.parse.quote(signature, safe=""), expiry)
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return float("nan")
+    return ordered[min(int(math.ceil(p / 100.0 * len(ordered))) - 1, len(ordered) - 1)] if p > 0 else ordered[0]
+
+
+class FleetStats:
+
+    def __init__(self):
+        self.connected = 0
+        self.connect_failures = 0
+        self.sent = 0
+        self.acknowledged = 0
+        self.errors = 0
+        self.bytes = 0
+        # latencies (in seconds) of the current report interval, and a reservoir sample of the whole run
+        self.interval_latencies = array("d")
+        self.samples = array("d")
+        self._seen = 0
+
+    def record(self, latency):
+        self.acknowledged += 1
+        self.interval_latencies.append(latency)
+        self._seen += 1
+        if len(self.samples) < LATENCY_SAMPLES:
+            self.samples.append(latency)
+        else:
+            index = random.randrange(self._seen)
+            if index < LATENCY_SAMPLES:
+                self.samples[index] = latency
+
+
+def create_reading(fields, padding):
+    reading = {}
+    for field in fields:
+        if field == "temperature":
+            reading[field] = TEMPERATURE + (random.random() * 15)
+        elif field == "humidity":
+            reading[field] = HUMIDITY + (random.random() * 20)
+        else:
+            reading[field] = random.random()
+    if padding:
+        reading["padding"] = "x" * padding
+    return reading
+
+
+def create_client(args, device_id):
+    if args.hub:
+        # IoT Hub MQTT conventions: TLS, the hub in the username and a SAS token derived from the device key
+        key = derive_device_key(device_id, args.group_key)
+        username = "{}/{}/?api-version={}".format(args.hub, device_id, IOTHUB_API_VERSION)
+        password = generate_sas_token("{}/devices/{}".format(args.hub, device_id), key)
+        return MqttClient(device_id, args.hub, 8883, username, password, ssl.create_default_context())
+    return MqttClient(device_id, args.host, args.port, ssl=ssl.create_default_context() if args.tls else None)
+
+
+async def run_device(index, args, encoder, stats, start, stop_at):
+    loop = asyncio.get_running_loop()
+    device_id = "{}-{:06d}".format(args.device_prefix, index)
+
+    # ramp up the connections at connect_rate per second, instead of connecting the whole fleet at once
+    await asyncio.sleep(max(start + index / args.connect_rate - loop.time(), 0))
+    client = create_client(args, device_id)
+    try:
+        await client.connect()
+    except Exception as ex:
+        stats.connect_failures += 1
+        if stats.connect_failures <= 10:
+            print("{} failed to connect: {}".format(device_id, ex))
+        return
+    stats.connected += 1
+
+    topic = "devices/{}/messages/events/".format(device_id)
+    if args.hub:
+        topic += urllib.parse.urlencode({"$.ct": encoder.content_type, "$.ce": encoder.content_encoding or ""})
+    in_flight = asyncio.Semaphore(args.max_in_flight)
+    fields = args.payload_fields.split(",")
+
+    def acknowledged(future, sent_at):
+        in_flight.release()
+        if future.cancelled() or future.exception() is not None:
+            stats.errors += 1
+        else:
+            stats.record(time.perf_counter() - sent_at)
+
+    # devices start at a random offset within the first period, so they do not send in lockstep
+    period = 1.0 / args.rate
+    next_send = loop.time() + random.uniform(0, period)
+    try:
+        while client.connected:
+            await asyncio.sleep(max(next_send - loop.time(), 0))
+            if loop.time() >= stop_at:
+                break
+            # when the device falls behind its schedule, it continues from now instead of bursting
+            next_send = max(next_send + period, loop.time())
+
+            await in_flight.acquire()
+            payload = encoder.encode(create_reading(fields, args.payload_padding))
+            sent_at = time.perf_counter()
+            try:
+                future = await client.publish(topic, payload)
+            except Exception:
+                in_flight.release()
+                stats.errors += 1
+                continue
+            stats.sent += 1
+            stats.bytes += len(payload)
+            future.add_done_callback(lambda f, sent_at=sent_at: acknowledged(f, sent_at))
+
+        # give the messages in flight some time to be acknowledged
+        for _ in range(args.max_in_flight):
+            await asyncio.wait_for(in_flight.acquire(), 10)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        await client.disconnect()
+
+
+async def report(stats, interval, label):
+    loop = asyncio.get_running_loop()
+    last_time, last_acknowledged = loop.time(), 0
+    while True:
+        await asyncio.sleep(interval)
+        now = loop.time()
+        latencies = sorted(stats.interval_latencies)
+        stats.interval_latencies = array("d")
+        rate = (stats.acknowledged - last_acknowledged) / (now - last_time)
+        last_time, last_acknowledged = now, stats.acknowledged
+        print("{}connected {} | {:.0f} msgs/s | latency ms p50 {:.1f} p95 {:.1f} p99 {:.1f} | errors {}".format(
+            label, stats.connected, rate, percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000, percentile(latencies, 99) * 1000, stats.errors))
+
+
+async def simulate(first, last, args):
+    loop = asyncio.get_running_loop()
+    encoder = create_encoder(args.encoding, args.payload_fields.split(","))
+    stats = FleetStats()
+    label = "[{}-{}] ".format(first, last - 1) if args.processes > 1 else ""
+    start = loop.time()
+    # the connect ramp-up is not part of the measured duration
+    stop_at = start + (last - first) / args.connect_rate + args.duration
+    reporter = asyncio.ensure_future(report(stats, args.report_interval, label))
+    started = time.perf_counter()
+    await asyncio.gather(*(run_device(index, args, encoder, stats, start - first / args.connect_rate, stop_at) for index in range(first, last)))
+    elapsed = time.perf_counter() - started
+    reporter.cancel()
+    return {
+        "connected": stats.connected,
+        "connectFailures": stats.connect_failures,
+        "sent": stats.sent,
+        "acknowledged": stats.acknowledged,
+        "errors": stats.errors,
+        "bytes": stats.bytes,
+        "elapsed": elapsed,
+        "samples": stats.samples.tobytes()
+    }
+
+
+def run_process(first, last, args):
+    return asyncio.run(simulate(first, last, args))
+
+
+def run_broker(host, port, latency):
+    async def serve():
+        server = await run_stand_in_broker(host, port, latency)
+        async with server:
+            await server.serve_forever()
+    asyncio.run(serve())
+
+
+def print_summary(results, args):
+    samples = array("d")
+    for result in results:
+        samples.frombytes(result["samples"])
+    latencies = sorted(samples)
+    acknowledged = sum(result["acknowledged"] for result in results)
+    # the processes run in parallel, so the throughput is based on the longest running one; during the
+    # ramp-up the devices send at half the target rate on average, so only half of it is counted
+    elapsed = max(result["elapsed"] for result in results)
+    measured = max(elapsed - args.devices / args.processes / args.connect_rate / 2, 1e-9)
+    print("\nDevices connected: {} of {} ({} failed)".format(sum(result["connected"] for result in results), args.devices,
+                                                           sum(result["connectFailures"] for result in results)))
+    print("Messages sent: {}, acknowledged: {}, errors: {}, bytes: {}".format(
+        sum(result["sent"] for result in results), acknowledged, sum(result["errors"] for result in results), sum(result["bytes"] for result in results)))
+    print("Throughput: {:.0f} msgs/s (target {:.0f} msgs/s)".format(acknowledged / measured, args.devices * args.rate))
+    print("Latency ms: p50 {:.1f} p90 {:.1f} p95 {:.1f} p99 {:.1f} max {:.1f}".format(
+        *(percentile(latencies, p) * 1000 for p in (50, 90, 95, 99, 100))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of IoT devices sending telemetry.")
+    parser.add_argument("--devices", type=int, default=100, help="number of simulated devices")
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second per device")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to send, after all devices connected")
+    parser.add_argument("--processes", type=int, default=1, help="number of processes, each with its own event loop")
+    parser.add_argument("--connect-rate", type=float, default=500, help="new connections per second (per process)")
+    parser.add_argument("--max-in-flight", type=int, default=16, help="unacknowledged messages per device")
+    parser.add_argument("--device-prefix", default="sim")
+    parser.add_argument("--payload-fields", default="temperature,humidity", help="comma separated fields of a reading")
+    parser.add_argument("--payload-padding", type=int, default=0, help="bytes of padding added to every reading")
+    parser.add_argument("--encoding", default="json", help="json, msgpack, cbor or struct (see payload_encoding.py)")
+    parser.add_argument("--report-interval", type=float, default=5)
+    parser.add_argument("--host", default="127.0.0.1", help="MQTT broker")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--tls", action="store_true", help="connect to the broker with TLS")
+    parser.add_argument("--stand-in-broker", action="store_true", help="start a local broker that acknowledges every message")
+    parser.add_argument("--broker-latency", type=float, default=0.0, help="seconds the stand-in broker waits before acknowledging")
+    parser.add_argument("--hub", help="IoT Hub host name; uses the IoT Hub MQTT conventions instead of --host/--port")
+    parser.add_argument("--group-key", default=os.getenv("DPS_GROUP_KEY"), help="primary key of the enrollment group (default: DPS_GROUP_KEY)")
+    args = parser.parse_args()
+
+    if args.hub and not args.group_key:
+        parser.error("--hub requires the group key (--group-key or DPS_GROUP_KEY) to derive the device keys")
+    if args.processes < 1 or args.devices < args.processes:
+        parser.error("--processes must be between 1 and the number of devices")
+
+    broker = None
+    if args.stand_in_broker:
+        broker = multiprocessing.Process(target=run_broker, args=(args.host, args.port, args.broker_latency), daemon=True)
+        broker.start()
+        time.sleep(0.5)
+
+    print("Simulating {} devices at {} msgs/s each for {} s".format(args.devices, args.rate, args.duration))
+    try:
+        if args.processes == 1:
+            results = [run_process(0, args.devices, args)]
+        else:
+            bounds = [args.devices * i // args.processes for i in range(args.processes + 1)]
+            with ProcessPoolExecutor(max_workers=args.processes) as executor:
+                futures = [executor.submit(run_process, bounds[i], bounds[i + 1], args) for i in range(args.processes)]
+                results = [future.result() for future in futures]
+        print_summary(results, args)
+    except KeyboardInterrupt:
+        print("\nFleet simulator stopped")
+    finally:
+        if broker is not None:
+            broker.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for full license information.
+
+# Minimal asyncio MQTT 3.1.1 client (CONNECT, PUBLISH QoS 0/1, PINGREQ, DISCONNECT) for load generation.
+# It uses no threads, so thousands of clients can share one event loop, which the Device SDK clients
+# cannot. It speaks the IoT Hub MQTT conventions when given the matching username, SAS token and TLS,
+# and plain MQTT against a local broker (e.g. mosquitto, or the stand-in broker below).
+import asyncio
+import struct
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+
+class MqttError(Exception):
+    pass
+
+
+def _encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0:
+            byte |= 0x80
+        encoded.append(byte)
+        if length == 0:
+            return bytes(encoded)
+
+
+def _encode_string(value):
+    data = value.encode("utf-8")
+    return struct.pack("!H", len(data)) + data
+
+
+async def _read_packet(reader):
+    header = await reader.readexactly(1)
+    length = 0
+    multiplier = 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+    body = await reader.readexactly(length) if length else b""
+    return header[0], body
+
+
+class MqttClient:
+
+    def __init__(self, client_id, host, port=1883, username=None, password=None, ssl=None, keepalive=60):
+        self.client_id = client_id
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.ssl = ssl
+        self.keepalive = keepalive
+        self.connected = False
+        self._reader = None
+        self._writer = None
+        self._next_packet_id = 0
+        self._pending = {}
+        self._connack = None
+        self._tasks = []
+
+    async def connect(self, timeout=30):
+        self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port, ssl=self.ssl), timeout)
+        flags = 0x02
+        payload = _encode_string(self.client_id)
+        if self.username is not None:
+            flags |= 0x80
+            payload += _encode_string(self.username)
+        if self.password is not None:
+            flags |= 0x40
+            payload += _encode_string(self.password)
+        variable_header = _encode_string("MQTT") + bytes([4, flags]) + struct.pack("!H", self.keepalive)
+        self._connack = asyncio.get_running_loop().create_future()
+        self._tasks.append(asyncio.ensure_future(self._read_loop()))
+        try:
+            self._send(CONNECT, variable_header + payload)
+            return_code = await asyncio.wait_for(self._connack, timeout)
+            if return_code != 0:
+                raise MqttError("Connection refused, return code {}".format(return_code))
+        except BaseException:
+            # no CONNACK in time, refused, lost or cancelled: stop the read loop and close the socket
+            self._close(MqttError("Connection failed"))
+            raise
+        self.connected = True
+        if self.keepalive:
+            self._tasks.append(asyncio.ensure_future(self._ping_loop()))
+
+    async def publish(self, topic, payload, qos=1):
+        # Returns once the message is written (waiting while the socket buffer is full).
+        # With QoS 1 the returned future completes when the broker acknowledged the message.
+        if not self.connected:
+            raise MqttError("Not connected")
+        future = asyncio.get_running_loop().create_future()
+        if qos == 0:
+            self._send(PUBLISH, _encode_string(topic) + payload)
+            future.set_result(None)
+        else:
+            self._next_packet_id = self._next_packet_id % 0xFFFF + 1
+            packet_id = self._next_packet_id
+            self._pending[packet_id] = future
+            self._send(PUBLISH | 0x02, _encode_string(topic) + struct.pack("!H", packet_id) + payload)
+        await self._writer.drain()
+        return future
+
+    async def disconnect(self):
+        if self._writer is None:
+            return
+        if self.connected:
+            self._send(DISCONNECT, b"")
+        self._close(MqttError("Disconnected"))
+        try:
+            await self._writer.wait_closed()
+        except (OSError, AttributeError):
+            pass
+
+    def _send(self, packet_type, body):
+        self._writer.write(bytes([packet_type]) + _encode_length(len(body)) + body)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                packet_type, body = await _read_packet(self._reader)
+                packet_type &= 0xF0
+                if packet_type == PUBACK:
+                    future = self._pending.pop(struct.unpack("!H", body[:2])[0], None)
+                    if future is not None and not future.done():
+                        future.set_result(None)
+                elif packet_type == CONNACK and not self._connack.done():
+                    self._connack.set_result(body[1])
+        except (asyncio.IncompleteReadError, OSError) as ex:
+            self._close(MqttError("Connection lost: {}".format(ex)))
+
+    async def _ping_loop(self):
+        while self.connected:
+            await asyncio.sleep(self.keepalive * 0.75)
+            if self.connected:
+                self._send(PINGREQ, b"")
+
+    def _close(self, error):
+        self.connected = False
+        for task in self._tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        self._tasks = []
+        if self._connack is not None and not self._connack.done():
+            self._connack.set_exception(error)
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+        self._writer.close()
+
+
+async def run_stand_in_broker(host="127.0.0.1", port=1883, latency=0.0):
+    # Accepts every connection and acknowledges every QoS 1 message after `latency` seconds.
+    # Messages are dropped, it is only meant as a target for load tests without a real broker.
+    loop = asyncio.get_running_loop()
+
+    def acknowledge(writer, packet_id):
+        if not writer.is_closing():
+            writer.write(bytes([PUBACK, 2]) + packet_id)
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                header, body = await _read_packet(reader)
+                packet_type = header & 0xF0
+                if packet_type == CONNECT:
+                    writer.write(bytes([CONNACK, 2, 0, 0]))
+                elif packet_type == PUBLISH and (header >> 1) & 0x03:
+                    topic_length = struct.unpack("!H", body[:2])[0]
+                    packet_id = body[2 + topic_length:4 + topic_length]
+                    if latency:
+                        loop.call_later(latency, acknowledge, writer, packet_id)
+                    else:
+                        acknowledge(writer, packet_id)
+                elif packet_type == PINGREQ:
+                    writer.write(bytes([PINGRESP, 0]))
+                elif packet_type == DISCONNECT:
+                    break
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
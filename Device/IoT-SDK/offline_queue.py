@@ -0,0 +1,49 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for full license information.
+import json
+import sqlite3
+
+
+class OfflineQueue:
+    # Disk-backed ring buffer for readings that could not be sent to IoT Hub.
+    # Readings are stored as JSON text in a SQLite database in WAL mode. The queue holds at most
+    # max_entries readings; when it is full the oldest readings are evicted. Readings are read
+    # oldest-first with peek() and only removed once they have been acknowledged by IoT Hub.
+
+    def __init__(self, path, max_entries=100000):
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+        self.max_entries = max_entries
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # WAL with synchronous=NORMAL survives a process crash, only a power loss may drop the last commits
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS readings (id INTEGER PRIMARY KEY AUTOINCREMENT, body TEXT NOT NULL)")
+        self._connection.commit()
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM readings").fetchone()[0]
+
+    def append(self, reading):
+        self.extend([reading])
+
+    def extend(self, readings):
+        with self._connection:
+            cursor = self._connection.executemany("INSERT INTO readings (body) VALUES (?)", ((json.dumps(reading),) for reading in readings))
+            last_id = self._connection.execute("SELECT MAX(id) FROM readings").fetchone()[0]
+            # ids are assigned in ascending order and only the oldest entries are removed, so everything
+            # at or below last_id - max_entries is beyond the capacity of the ring buffer
+            cursor.execute("DELETE FROM readings WHERE id <= ?", (last_id - self.max_entries,))
+
+    def peek(self, max_count):
+        # returns the ids and the JSON encoded bodies of the oldest readings
+        rows = self._connection.execute("SELECT id, body FROM readings ORDER BY id LIMIT ?", (max_count,)).fetchall()
+        return [row[0] for row in rows], [row[1] for row in rows]
+
+    def remove(self, last_id):
+        # remove all readings up to and including last_id, after they have been sent
+        with self._connection:
+            self._connection.execute("DELETE FROM readings WHERE id <= ?", (last_id,))
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,66 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for full license information.
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+
+
+class RegistrationCache:
+    # Local cache of the DPS registration result (the assigned IoT hub), so a restarting device can
+    # connect directly to its hub instead of registering with DPS again.
+    # The entry is signed with an HMAC keyed with the device key: a corrupted or tampered file, or a
+    # file written for other credentials, is ignored.
+
+    def __init__(self, path, id_scope, registration_id, device_key):
+        self.path = path
+        self.id_scope = id_scope
+        self.registration_id = registration_id
+        self._secret = hashlib.sha256(device_key.encode("utf-8")).digest()
+
+    def load(self):
+        # returns the cached assigned hub and device id as (hub, device_id), or None
+        try:
+            with open(self.path, "r") as f:
+                entry = json.load(f)
+            registration = entry["registration"]
+            signature = entry["signature"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if not isinstance(registration, dict) or not isinstance(signature, str):
+            print("Ignoring the DPS registration cache: invalid format")
+            return None
+
+        # compared as bytes, compare_digest raises TypeError for str with non-ASCII characters
+        if not hmac.compare_digest(signature.encode("utf-8"), self._sign(registration).encode("utf-8")):
+            print("Ignoring the DPS registration cache: integrity check failed")
+            return None
+        if registration.get("idScope") != self.id_scope or registration.get("registrationId") != self.registration_id:
+            return None
+        return registration["assignedHub"], registration["deviceId"]
+
+    def save(self, assigned_hub, device_id):
+        registration = {
+            "idScope": self.id_scope,
+            "registrationId": self.registration_id,
+            "assignedHub": assigned_hub,
+            "deviceId": device_id,
+            "registeredAt": time.time()
+        }
+        # write-rename, so a crash never leaves a truncated file behind
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"registration": registration, "signature": self._sign(registration)}, f)
+        os.replace(temp_path, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _sign(self, registration):
+        content = json.dumps(registration, sort_keys=True).encode("utf-8")
+        return base64.b64encode(hmac.new(self._secret, content, hashlib.sha256).digest()).decode("utf-8")
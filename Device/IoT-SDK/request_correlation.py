@@ -0,0 +1,60 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for full license information.
+import asyncio
+import time
+import uuid
+
+
+class RequestCorrelator:
+    # Correlates requests sent to a cloud service with their responses, which arrive independently
+    # (e.g. as a direct method call with the request ids echoed back).
+    # request() stamps a new request id, sends the request with send_request(request_id) and waits for
+    # resolve(request_id, response). Many requests can be outstanding at the same time, at most
+    # max_outstanding; request() waits for a free slot when the limit is reached.
+    # A request without response within its timeout raises asyncio.TimeoutError, a response arriving
+    # after the timeout is ignored. All methods must be called from the event loop.
+
+    def __init__(self, send_request, timeout=30, max_outstanding=100):
+        if max_outstanding < 1:
+            raise ValueError("max_outstanding must be at least 1")
+        # send_request(request_id) is a coroutine that sends the request, e.g. a device-to-cloud message
+        self.send_request = send_request
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(max_outstanding)
+        self._pending = {}
+
+    @property
+    def outstanding(self):
+        return len(self._pending)
+
+    async def request(self, timeout=None):
+        # returns the response and the round-trip time in seconds
+        await self._slots.acquire()
+        request_id = str(uuid.uuid4())
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        started = time.perf_counter()
+        try:
+            await self.send_request(request_id)
+            try:
+                response = await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+            except asyncio.TimeoutError:
+                raise asyncio.TimeoutError("No response to request {} within {} s".format(request_id, self.timeout if timeout is None else timeout))
+            return response, time.perf_counter() - started
+        finally:
+            del self._pending[request_id]
+            self._slots.release()
+
+    def resolve(self, request_id, response):
+        # completes the request; returns False for an unknown request id (e.g. after the timeout)
+        future = self._pending.get(request_id)
+        if future is None or future.done():
+            return False
+        future.set_result(response)
+        return True
+
+    def fail_all(self, error):
+        # e.g. on shutdown: every outstanding request raises error
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
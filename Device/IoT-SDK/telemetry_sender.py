@@ -0,0 +1,121 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for full license information.
+import asyncio
+
+from payload_encoding import JsonEncoder
+
+# IoT Hub rejects messages larger than 256 KB (body and properties), keep some headroom for the properties
+MAX_MESSAGE_BYTES = 240 * 1024
+
+
+class TelemetrySender:
+    # Pipelined telemetry sender.
+    # Readings are encoded with `encoder` (compact JSON by default, see payload_encoding.py) and packed into
+    # batches, which are flushed when max_batch_count readings, max_batch_bytes of payload or max_batch_age
+    # seconds are reached. A batch of one reading is sent as a single object, larger batches as an array.
+    # Up to max_in_flight messages are sent concurrently, add() waits when the window is full.
+    # A failed send is passed to on_send_failed(readings, exception) if given, otherwise it is raised
+    # by the next call to add() or stop().
+
+    def __init__(self, send_message, create_message, max_in_flight=4, max_batch_count=1, max_batch_bytes=MAX_MESSAGE_BYTES, max_batch_age=1.0,
+                 on_send_failed=None, encoder=None):
+        if max_in_flight < 1 or max_batch_count < 1:
+            raise ValueError("max_in_flight and max_batch_count must be at least 1")
+        if max_batch_bytes > MAX_MESSAGE_BYTES:
+            raise ValueError("max_batch_bytes must not exceed {} bytes".format(MAX_MESSAGE_BYTES))
+
+        # send_message(message) is a coroutine (e.g. IoTHubDeviceClient.send_message)
+        # create_message(body, readings) builds the Message for a batch from the encoded body, e.g. to add custom properties
+        self.send_message = send_message
+        self.create_message = create_message
+        self.max_batch_count = max_batch_count
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_age = max_batch_age
+        self.on_send_failed = on_send_failed
+        self.encoder = encoder if encoder is not None else JsonEncoder()
+
+        self._window = asyncio.Semaphore(max_in_flight)
+        self._in_flight = set()
+        self._readings = []
+        self._encoded = []
+        self._batch_bytes = 0
+        self._age_timer = None
+        # flushes started by the age timer, they may still wait for a free slot in the window
+        self._age_flushes = set()
+        self._error = None
+
+    @property
+    def in_flight(self):
+        return len(self._in_flight)
+
+    @property
+    def pending(self):
+        return len(self._readings)
+
+    async def add(self, reading):
+        self._raise_send_error()
+
+        encoded = self.encoder.encode(reading)
+        size = len(encoded) + self.encoder.item_overhead
+        if size + self.encoder.batch_overhead > self.max_batch_bytes:
+            raise ValueError("A single reading exceeds the maximum batch size of {} bytes".format(self.max_batch_bytes))
+        if self._readings and self._batch_bytes + size + self.encoder.batch_overhead > self.max_batch_bytes:
+            await self.flush()
+
+        self._readings.append(reading)
+        self._encoded.append(encoded)
+        self._batch_bytes += size
+
+        if len(self._readings) >= self.max_batch_count:
+            await self.flush()
+        elif self._age_timer is None:
+            self._age_timer = asyncio.get_running_loop().call_later(self.max_batch_age, self._flush_on_age)
+
+    async def flush(self):
+        if self._age_timer is not None:
+            self._age_timer.cancel()
+            self._age_timer = None
+        if not self._readings:
+            return
+
+        readings, encoded = self._readings, self._encoded
+        self._readings, self._encoded, self._batch_bytes = [], [], 0
+
+        message = self.create_message(self.encoder.join(encoded), readings)
+
+        # wait for a free slot in the in-flight window, then send without waiting for the acknowledgement
+        await self._window.acquire()
+        task = asyncio.ensure_future(self._send(message, readings))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def stop(self):
+        # flush the open batch and wait until all messages in flight are acknowledged
+        if self._age_flushes:
+            await asyncio.wait(list(self._age_flushes))
+        await self.flush()
+        if self._in_flight:
+            await asyncio.wait(list(self._in_flight))
+        self._raise_send_error()
+
+    async def _send(self, message, readings):
+        try:
+            await self.send_message(message)
+        except Exception as ex:
+            if self.on_send_failed is not None:
+                self.on_send_failed(readings, ex)
+            elif self._error is None:
+                self._error = ex
+        finally:
+            self._window.release()
+
+    def _flush_on_age(self):
+        self._age_timer = None
+        task = asyncio.ensure_future(self.flush())
+        self._age_flushes.add(task)
+        task.add_done_callback(self._age_flushes.discard)
+
+    def _raise_send_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
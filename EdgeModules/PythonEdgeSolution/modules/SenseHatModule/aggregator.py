@@ -0,0 +1,260 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for
+# full license information.
+
+# Streaming aggregation of sensor readings.
+# Every window supports O(1) updates without allocating per sample. A summary contains
+# count, min, max, mean, stddev and the configured percentiles (e.g. p50, p95).
+#   - TumblingWindow aggregates all samples since the last reset (Welford mean/variance, P2 percentile estimates)
+#   - SlidingWindow keeps the last `size` samples in a ring buffer and computes exact statistics on summary()
+#   - ChannelAggregator holds one window per sensor channel
+
+import math
+import random
+import sys
+import time
+from array import array
+
+DEFAULT_PERCENTILES = (50, 95)
+
+
+class P2Quantile:
+    # P-square algorithm (Jain & Chlamtac, 1985): estimates a quantile with five markers, without storing the samples.
+
+    def __init__(self, p):
+        if not 0 < p < 1:
+            raise ValueError("p must be between 0 and 1")
+        self.p = p
+        self.heights = array('d', [0.0] * 5)
+        self.positions = array('d', [0.0] * 5)
+        self.desired = array('d', [0.0] * 5)
+        self.increments = (0.0, p / 2, p, (1 + p) / 2, 1.0)
+        self.reset()
+
+    def reset(self):
+        p = self.p
+        self.count = 0
+        for i in range(5):
+            self.positions[i] = i
+        self.desired[0], self.desired[1], self.desired[2], self.desired[3], self.desired[4] = 0.0, 2 * p, 4 * p, 2 + 2 * p, 4.0
+
+    def add(self, x):
+        q = self.heights
+        n = self.positions
+
+        if self.count < 5:
+            q[self.count] = x
+            self.count += 1
+            if self.count == 5:
+                ordered = sorted(q)
+                for i in range(5):
+                    q[i] = ordered[i]
+            return
+        self.count += 1
+
+        # find the cell k with q[k] <= x < q[k + 1], extending the extreme markers if needed
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # adjust the heights of the three middle markers
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                parabolic = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                    (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if q[i - 1] < parabolic < q[i + 1]:
+                    q[i] = parabolic
+                else:
+                    q[i] = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                n[i] += d
+
+    def value(self):
+        if self.count == 0:
+            return None
+        if self.count < 5:
+            # not enough samples for the markers yet, use the exact quantile
+            return _quantile(sorted(self.heights[:self.count]), self.p)
+        return self.heights[2]
+
+
+class TumblingWindow:
+    # Aggregates all samples added since the last reset()
+
+    # indexes into the state array
+    _COUNT, _MEAN, _M2, _MIN, _MAX = range(5)
+
+    def __init__(self, percentiles=DEFAULT_PERCENTILES):
+        self.percentiles = tuple(percentiles)
+        self._state = array('d', [0.0] * 5)
+        self._quantiles = [P2Quantile(percentile / 100.0) for percentile in self.percentiles]
+        self.reset()
+
+    def reset(self):
+        state = self._state
+        state[self._COUNT] = state[self._MEAN] = state[self._M2] = 0.0
+        state[self._MIN] = math.inf
+        state[self._MAX] = -math.inf
+        for quantile in self._quantiles:
+            quantile.reset()
+
+    def __len__(self):
+        return int(self._state[self._COUNT])
+
+    def add(self, value):
+        state = self._state
+        # Welford's online algorithm for mean and variance
+        state[self._COUNT] += 1
+        delta = value - state[self._MEAN]
+        state[self._MEAN] += delta / state[self._COUNT]
+        state[self._M2] += delta * (value - state[self._MEAN])
+        if value < state[self._MIN]:
+            state[self._MIN] = value
+        if value > state[self._MAX]:
+            state[self._MAX] = value
+        for quantile in self._quantiles:
+            quantile.add(value)
+
+    def summary(self):
+        state = self._state
+        count = int(state[self._COUNT])
+        if count == 0:
+            return {"count": 0}
+        summary = {
+            "count": count,
+            "min": state[self._MIN],
+            "max": state[self._MAX],
+            "mean": state[self._MEAN],
+            "stddev": math.sqrt(state[self._M2] / count)
+        }
+        for percentile, quantile in zip(self.percentiles, self._quantiles):
+            summary["p%g" % percentile] = quantile.value()
+        return summary
+
+
+class SlidingWindow:
+    # Keeps the last `size` samples in a preallocated ring buffer.
+    # add() is O(1), summary() is O(size) and computes exact statistics.
+
+    def __init__(self, size, percentiles=DEFAULT_PERCENTILES):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.size = size
+        self.percentiles = tuple(percentiles)
+        self._values = array('d', [0.0] * size)
+        self.reset()
+
+    def reset(self):
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, value):
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self.size
+        if self._count < self.size:
+            self._count += 1
+
+    def summary(self):
+        count = self._count
+        if count == 0:
+            return {"count": 0}
+        values = self._values if count == self.size else self._values[:count]
+        ordered = sorted(values)
+        mean = math.fsum(ordered) / count
+        variance = math.fsum((value - mean) ** 2 for value in ordered) / count
+        summary = {
+            "count": count,
+            "min": ordered[0],
+            "max": ordered[-1],
+            "mean": mean,
+            "stddev": math.sqrt(variance)
+        }
+        for percentile in self.percentiles:
+            summary["p%g" % percentile] = _quantile(ordered, percentile / 100.0)
+        return summary
+
+
+class ChannelAggregator:
+    # One window per sensor channel, e.g. "temperature" or "accelerationX".
+    # create_window is called once per channel, e.g. lambda: SlidingWindow(50)
+
+    def __init__(self, channels, create_window=TumblingWindow):
+        self.channels = tuple(channels)
+        self._windows = {channel: create_window() for channel in self.channels}
+
+    def add(self, channel, value):
+        self._windows[channel].add(value)
+
+    def add_sample(self, sample):
+        # add a dict of channel -> value, e.g. {"temperature": 21.3, "humidity": 40.2}
+        for channel, value in sample.items():
+            self._windows[channel].add(value)
+
+    def count(self, channel):
+        return len(self._windows[channel])
+
+    def summary(self):
+        return {channel: window.summary() for channel, window in self._windows.items()}
+
+    def reset(self):
+        for window in self._windows.values():
+            window.reset()
+
+
+def create_window_factory(mode, size, percentiles=DEFAULT_PERCENTILES):
+    # mode is "tumbling" or "sliding"; size is the number of samples kept by a sliding window
+    if mode == "tumbling":
+        return lambda: TumblingWindow(percentiles)
+    if mode == "sliding":
+        return lambda: SlidingWindow(size, percentiles)
+    raise ValueError("Unknown aggregation window '%s', use 'tumbling' or 'sliding'" % mode)
+
+
+def _quantile(ordered, p):
+    # linear interpolation between the closest ranks of a sorted sequence
+    position = p * (len(ordered) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def benchmark(mode="tumbling", size=100, samples=200000):
+    # Feed simulated readings (the same random values main.py uses without a SenseHat) and report the throughput
+    channels = ("temperature", "pressure", "humidity", "accelerationX", "accelerationY", "accelerationZ")
+    aggregator = ChannelAggregator(channels, create_window_factory(mode, size))
+    start = time.perf_counter()
+    for i in range(samples):
+        aggregator.add("temperature", random.randint(100, 300) / 10.0)
+        aggregator.add("pressure", random.randint(9000, 11000) / 10.0)
+        aggregator.add("humidity", random.randint(100, 800) / 10.0)
+        aggregator.add("accelerationX", random.random())
+        aggregator.add("accelerationY", random.random())
+        aggregator.add("accelerationZ", random.random())
+        if i % size == size - 1:
+            aggregator.summary()
+            if mode == "tumbling":
+                aggregator.reset()
+    elapsed = time.perf_counter() - start
+    print("%s window (%d samples): %d samples/s, %.2f us per channel update" % (mode, size, samples / elapsed, elapsed / (samples * len(channels)) * 1e6))
+
+
+if __name__ == "__main__":
+    # python3 aggregator.py [tumbling|sliding] [window size] [samples]
+    benchmark(*(sys.argv[1:2] + [int(arg) for arg in sys.argv[2:4]]))
@@ -14,18 +14,21 @@ from azure.iot.device import Message
 from sense_hat import SenseHat
 import json
 import random
+from aggregator import ChannelAggregator, create_window_factory
+from sampler import SensorSampler
+from payload_encoding import create_encoder
+from report_filter import ReportByException
+from metrics import Metrics, start_metrics_server, creation_timestamp, CREATION_TIME_PROPERTY
+from vibration import VibrationBuffer, FORMAT as VIBRATION_FORMAT
+from connection_supervisor import ConnectionSupervisor
 
-maxAccX=0
-maxAccY=0
-maxAccZ=0
-sumTemp=0
-sumHum=0
-sumPres=0
-measurement_count=0
+SENSOR_CHANNELS = ("temperature", "pressure", "humidity", "accelerationX", "accelerationY", "accelerationZ")
+# fields of the message on the sensors output (the field order of the struct encoding)
+PAYLOAD_FIELDS = ("temperature", "pressure", "humidity", "accellerationX", "accellerationY", "accellerationZ")
 
 async def main():
     try:
-        if not sys.version >= "3.5.3":
+        if sys.version_info < (3, 5, 3):
             raise Exception( "The sample requires python 3.5.3+. Current version of Python: %s" % sys.version )
         print ( "IoT Hub Client for Python" )
 
@@ -37,9 +40,21 @@ async def main():
             print ( "SenseHat error %s " % e )
 
         # The client object is used to interact with your Azure IoT hub.
-        module_client = IoTHubModuleClient.create_from_edge_environment()
-        # connect the client.
-        await module_client.connect()
+        # The SDK's own reconnect (a fixed interval) and the automatic connect on send are turned off,
+        # only the connection supervisor below reconnects, after a backoff with jitter
+        module_client = IoTHubModuleClient.create_from_edge_environment(connection_retry=False, auto_connect=False)
+
+        # The connection to edgeHub is supervised (connection_supervisor.py): a lost connection is re-established and
+        # failed sends are retried up to SendMaxAttempts times, after a random delay of up to the exponential backoff
+        # (at most ReconnectMaxDelay seconds). While disconnected no messages are sent, the tumbling window keeps
+        # aggregating; vibration chunks are drained with at most DrainRate messages per second.
+        reconnectMaxDelay = float(os.environ.get('ReconnectMaxDelay', 60))
+        sendMaxAttempts = int(os.environ.get('SendMaxAttempts', 4))
+        drainRate = float(os.environ.get('DrainRate', 5))
+        supervisor = ConnectionSupervisor(module_client, 1, reconnectMaxDelay, sendMaxAttempts, drainRate)
+        # connect the client, retried with backoff and jitter while edgeHub is not reachable
+        await supervisor.connect()
+        supervisor.start()
 
         def write_on_sensehat(patch):
             print("the data in the desired properties patch was: {}".format(patch))
@@ -68,83 +83,214 @@ async def main():
             except Exception as e:
                 print("Twin patch error %s " % e)
 
-        async def readSensors():
-            global maxAccX
-            global maxAccY
-            global maxAccZ
-            global sumTemp
-            global sumHum
-            global sumPres
-            global measurement_count
+        # Aggregation of the readings between two messages. A tumbling window covers all readings since the
+        # last message, a sliding window the last SlidingWindowSize readings of every sensor.
+        aggregationWindow = os.environ.get('AggregationWindow', 'tumbling')
+        slidingWindowSize = int(os.environ.get('SlidingWindowSize', 50))
+        sendStatistics = os.environ.get('SendStatistics', 'false').lower() == 'true'
+        aggregator = ChannelAggregator(SENSOR_CHANNELS, create_window_factory(aggregationWindow, slidingWindowSize))
+        print("Aggregation window: %s" % aggregationWindow)
+
+        # json (default), msgpack, cbor or struct, see payload_encoding.py
+        payloadEncoding = os.environ.get('PayloadEncoding', 'json')
+        encoder = create_encoder(payloadEncoding, PAYLOAD_FIELDS)
+        if sendStatistics and payloadEncoding == 'struct':
+            raise ValueError("SendStatistics is not supported with the struct payload encoding")
+        print("Payload encoding: %s" % payloadEncoding)
+
+        # Optional raw accelerometer stream on the output "vibration": chunks of VibrationChunkSize samples per axis,
+        # quantized to int16 (VibrationScale g per LSB) and compressed with zlib, with RMS, peak and FFT features
+        # (NumPy) as message properties, see vibration.py
+        vibrationStream = os.environ.get('VibrationStream', 'false').lower() == 'true'
+        vibrationChunkSize = int(os.environ.get('VibrationChunkSize', 1024))
+        vibrationScale = float(os.environ.get('VibrationScale', 0.001))
+        vibrationCompressionLevel = int(os.environ.get('VibrationCompressionLevel', 6))
+        # chunks waiting to be sent; when the upstream is slower, the oldest chunk is dropped
+        vibrationQueue = asyncio.Queue(maxsize=10)
+        vibrationChunksDropped = 0
 
+        # Metrics are reported with the sampling statistics, and served in the Prometheus text format on
+        # http://<module>:<MetricsPort>/metrics when MetricsPort is set
+        metrics = Metrics("sensehat_")
+        metrics.describe("send_latency_seconds", "Time from sending a message until edgeHub acknowledged it")
+        metrics.describe("send_data_duration_seconds", "Time to aggregate, encode and send the readings of one interval")
+        metrics.describe("messages_sent_total", "Messages acknowledged by edgeHub")
+        metrics.describe("bytes_sent_total", "Size of the bodies of the messages acknowledged by edgeHub")
+        metricsPort = int(os.environ['MetricsPort']) if 'MetricsPort' in os.environ else None
+
+        # report by exception, configured with the desired property ReportByException
+        reportFilter = ReportByException()
+
+        def update_report_filter(patch):
+            if 'ReportByException' not in patch:
+                return
+            try:
+                settings = dict(patch['ReportByException'])
+                if settings.get('delta') and payloadEncoding == 'struct':
+                    print("Delta reports are not supported with the struct payload encoding, sending full reports")
+                    settings['delta'] = False
+                reportFilter.configure(settings)
+                print("Report by exception: %s" % reportFilter.settings)
+            except (AttributeError, TypeError, ValueError) as e:
+                print("Invalid ReportByException settings: %s" % e)
+
+        # Every sensor is read by its own function, called on the sampling thread at the sensor's own rate,
+        # so the blocking SenseHat I/O never stalls the event loop
+        def readAccelerometer():
             if senseHatAvailable:
                 acceleration = sense.get_accelerometer_raw()
                 x = acceleration['x']
                 y = acceleration['y']
                 z = acceleration['z']
-
-                if maxAccX < abs(x): maxAccX = x
-                if maxAccY < abs(y): maxAccY = y
-                if maxAccZ < abs(z): maxAccZ = z
-
-                # Take readings from all three sensors and round the values to one decimal place
-                t = round(sense.get_temperature(), 1)
-                p = round(sense.get_pressure(), 1)
-                h = round(sense.get_humidity(), 1)
-                sumTemp += t
-                sumPres += p
-                sumHum += h
             else:
                 x = random.random()
                 y = random.random()
                 z = random.random()
-                sumTemp += random.randint(100, 300)/10.0
-                sumPres += random.randint(9000, 11000)/10.0
-                sumHum += random.randint(100, 800)/10.0
-                time.sleep(0.5)
+            # signed values, the vibration stream needs the direction
+            return {"accelerationX": x, "accelerationY": y, "accelerationZ": z}
 
-            measurement_count += 1
-            # print(measurement_count)
+        # Take readings from the environmental sensors and round the values to one decimal place
+        def readTemperature():
+            if senseHatAvailable:
+                return {"temperature": round(sense.get_temperature(), 1)}
+            return {"temperature": random.randint(100, 300)/10.0}
 
-        async def sendData():
-            global maxAccX
-            global maxAccY
-            global maxAccZ
-            global sumTemp
-            global sumHum
-            global sumPres
-            global measurement_count
+        def readPressure():
+            if senseHatAvailable:
+                return {"pressure": round(sense.get_pressure(), 1)}
+            return {"pressure": random.randint(9000, 11000)/10.0}
+
+        def readHumidity():
+            if senseHatAvailable:
+                return {"humidity": round(sense.get_humidity(), 1)}
+            return {"humidity": random.randint(100, 800)/10.0}
+
+        if 'ReadInterval' not in os.environ:
+            readInterval = 5
+        else:
+            readInterval = float(os.environ['ReadInterval'])
+
+        # Sample rates in Hz, from the environment (e.g. AccelerometerSampleRate=100) or the SampleInterval default.
+        # They can be changed at runtime with the desired property SampleRates, e.g. {"accelerometer": 50}.
+        # Every sensor needs at least one sample per ReadInterval, otherwise intervals are skipped and windows merge,
+        # so slower rates are raised to 1 / ReadInterval.
+        minSampleRate = 1.0 / readInterval
+
+        def limit_sample_rate(name, rate):
+            if rate <= 0:
+                raise ValueError("the sample rate must be positive")
+            if rate < minSampleRate:
+                print("Sample rate of %s raised from %s to %s Hz, ReadInterval is %s s" % (name, rate, minSampleRate, readInterval))
+                return minSampleRate
+            return rate
+
+        if 'SampleInterval' not in os.environ:
+            sampleInterval = 0.1
+        else:
+            sampleInterval = float(os.environ['SampleInterval'])
+        sensors = {
+            "accelerometer": readAccelerometer,
+            "temperature": readTemperature,
+            "pressure": readPressure,
+            "humidity": readHumidity
+        }
+        sampleRates = {}
+        for name in sensors:
+            variable = name.capitalize() + 'SampleRate'
+            sampleRates[name] = limit_sample_rate(name, float(os.environ[variable]) if variable in os.environ else 1.0 / sampleInterval)
+        print("Sensor sample rates (Hz): %s" % sampleRates)
+        vibration = VibrationBuffer(sampleRates["accelerometer"], vibrationChunkSize, vibrationScale) if vibrationStream else None
+
+        loop = asyncio.get_running_loop()
+        sampler = SensorSampler({name: (read, 1.0 / sampleRates[name]) for name, read in sensors.items()}, loop)
+        metrics.gauge("sample_queue_depth", sampler.queue.qsize)
+        metrics.gauge("samples_dropped", lambda: sampler.dropped)
+        metrics.gauge("vibration_chunks_dropped", lambda: vibrationChunksDropped)
+        metrics.gauge("connected", lambda: int(supervisor.connected))
+        metrics.gauge("reconnects", lambda: supervisor.reconnects)
+        metrics.gauge("send_retries", lambda: supervisor.retries)
 
+        def queueVibrationChunk(chunk):
+            nonlocal vibrationChunksDropped
+            if chunk is None:
+                return
+            if vibrationQueue.full():
+                vibrationQueue.get_nowait()
+                vibrationChunksDropped += 1
+            vibrationQueue.put_nowait(chunk)
+
+        def changeVibrationSampleRate(rate):
+            # runs on the event loop, like the aggregation that fills the buffer
+            queueVibrationChunk(vibration.set_sample_rate(rate))
+
+        def update_sample_rates(patch):
+            if 'SampleRates' not in patch:
+                return
+            for name, rate in patch['SampleRates'].items():
+                try:
+                    rate = limit_sample_rate(name, float(rate))
+                    sampler.set_rate(name, rate)
+                    print("Sample rate of %s set to %s Hz" % (name, rate))
+                    if name == "accelerometer" and vibration is not None:
+                        # twin patches are handled on the SDK's event loop
+                        loop.call_soon_threadsafe(changeVibrationSampleRate, rate)
+                except (TypeError, ValueError) as e:
+                    print("Invalid sample rate for %s: %s" % (name, e))
+
+        async def sendData():
             # get average
-            if measurement_count != 0:
-                t = round(sumTemp/measurement_count, 1)
-                p = round(sumPres/measurement_count, 1)
-                h = round(sumHum/measurement_count, 1)
-                # print("received values from {0} measurements".format(measurement_count))
-                message = '{{"temperature":{0},"pressure":{1},"humidity":{2},"accellerationX":{3},"accellerationY":{4},"accellerationZ":{5}}}'.format(str(t), str(p), str(h), str(maxAccX), str(maxAccY), str(maxAccZ))
-                print(message)
-
-                # msg = Message('{"temperature":' + str(t) +',"pressure":'+str(p)+',"humidity":'+str(h)+'}')
-                msg = Message(message)
+            # every sensor needs at least one sample in the window, ReadInterval must not be shorter than the slowest sample period
+            if all(aggregator.count(channel) != 0 for channel in SENSOR_CHANNELS):
+                summary = aggregator.summary()
+                payload = {
+                    "temperature": round(summary["temperature"]["mean"], 1),
+                    "pressure": round(summary["pressure"]["mean"], 1),
+                    "humidity": round(summary["humidity"]["mean"], 1),
+                    "accellerationX": summary["accelerationX"]["max"],
+                    "accellerationY": summary["accelerationY"]["max"],
+                    "accellerationZ": summary["accelerationZ"]["max"]
+                }
+                # print("received values from {0} measurements".format(summary["temperature"]["count"]))
+                if sendStatistics:
+                    payload["statistics"] = summary
+
+                # a tumbling window starts over, whether the aggregate is sent or not
+                if aggregationWindow == "tumbling":
+                    aggregator.reset()
+
+                payload, payloadType = reportFilter.filter(payload, loop.time())
+                if payload is None:
+                    print("No significant change, message suppressed")
+                    return
+                print(payload)
+
+                msg = Message(encoder.encode(payload))
                 # print("Sending message: %s" % msg)
                 msg.message_id = uuid.uuid4()
                 msg.correlation_id = "senseHat-"+str(uuid.uuid4())
-                msg.content_encoding = "utf-8"
-                msg.content_type = "application/json"                    
-                await module_client.send_message_to_output(msg, "sensors")
+                msg.custom_properties[CREATION_TIME_PROPERTY] = creation_timestamp()
+                msg.content_type = encoder.content_type
+                if encoder.content_encoding is not None:
+                    msg.content_encoding = encoder.content_encoding
+                for name, value in encoder.properties.items():
+                    msg.custom_properties[name] = value
+                if reportFilter.enabled:
+                    msg.custom_properties["payloadType"] = payloadType
+                sendStarted = time.perf_counter()
+                await supervisor.call(module_client.send_message_to_output, msg, "sensors")
+                metrics.observe("send_latency_seconds", time.perf_counter() - sendStarted)
+                metrics.inc("messages_sent_total")
+                metrics.inc("bytes_sent_total", len(msg.data))
                 print("Message sent")
-                
-                maxAccX=0
-                maxAccY=0
-                maxAccZ=0
-                sumTemp=0
-                sumHum=0
-                sumPres=0
-                measurement_count=0
 
         # define behavior for receiving a twin patch
         async def twin_patch_handler(patch):
-            write_on_sensehat(patch)
+            update_sample_rates(patch)
+            # twin patches are handled on the SDK's event loop, the filter is used by sendData() on the application loop
+            loop.call_soon_threadsafe(update_report_filter, patch)
+            if 'Message' in patch or not any(key in patch for key in ('SampleRates', 'ReportByException')):
+                # scrolling a message over the LED matrix takes seconds, keep it off the event loop
+                await asyncio.get_running_loop().run_in_executor(None, write_on_sensehat, patch)
             await module_client.patch_twin_reported_properties(patch)
 
         # set the twin patch handler on the client
@@ -154,57 +300,119 @@ async def main():
         twin = await module_client.get_twin()
         print("Got current twin to write to the senseHat.")
         if ('desired' in twin):
+            update_sample_rates(twin["desired"])
+            update_report_filter(twin["desired"])
             write_on_sensehat(twin["desired"])
         else:
             print("desired property is missing in twin")
 
         print("Starting sensor readings")
-        if 'ReadInterval' not in os.environ:
-            readInterval = 5
-        else:
-            readInterval = int(os.environ['ReadInterval'])
         print("Sensor read interval: %s" % str(readInterval))
 
-        counter = readInterval
-        start = time.time()
-        while True:
-            try:
-                time.sleep(0.1)
-                # print("[%s] Reading sensors" % datetime.datetime.now())
-                # if senseHatAvailable:
-                #     # Take readings from all three sensors and round the values to one decimal place
-                #     t = round(sense.get_temperature(), 1)
-                #     p = round(sense.get_pressure(), 1)
-                #     h = round(sense.get_humidity(), 1)
-                # else:
-                #     t = random.randint(100, 300)/10.0
-                #     p = random.randint(9000, 11000)/10.0
-                #     h = random.randint(100, 800)/10.0
-                await readSensors()
-
-                if time.time() - start > 1:
-                    start = time.time()
-                    counter -= 1
-
-                if counter <= 0:
+        sampler.start()
+
+        async def aggregateSamples():
+            while True:
+                sample = await sampler.queue.get()
+                if "accelerationX" in sample:
+                    if vibration is not None:
+                        queueVibrationChunk(vibration.add(sample["accelerationX"], sample["accelerationY"], sample["accelerationZ"]))
+                    # the peak acceleration is reported as magnitude, regardless of the direction
+                    sample = {channel: abs(value) for channel, value in sample.items()}
+                aggregator.add_sample(sample)
+
+        def createVibrationMessage(chunk):
+            # runs on a worker thread, the chunk is no longer touched by the event loop
+            msg = Message(chunk.encode(vibrationCompressionLevel))
+            msg.message_id = uuid.uuid4()
+            msg.content_type = "application/octet-stream"
+            msg.custom_properties["vibrationFormat"] = VIBRATION_FORMAT
+            msg.custom_properties["sampleRate"] = str(chunk.sample_rate)
+            msg.custom_properties["sampleCount"] = str(len(chunk))
+            msg.custom_properties[CREATION_TIME_PROPERTY] = creation_timestamp()
+            for axis, features in chunk.features().items():
+                msg.custom_properties["rms" + axis] = "%.5f" % features["rms"]
+                msg.custom_properties["peak" + axis] = "%.5f" % features["peak"]
+                msg.custom_properties["crestFactor" + axis] = "%.3f" % features["crestFactor"]
+                if "dominantFrequencies" in features:
+                    msg.custom_properties["dominantFrequencies" + axis] = ",".join(str(frequency) for frequency in features["dominantFrequencies"])
+            return msg
+
+        async def sendVibrationChunks():
+            while True:
+                chunk = await vibrationQueue.get()
+                try:
+                    await supervisor.wait_connected()
+                    await supervisor.pace()
+                    msg = await loop.run_in_executor(None, createVibrationMessage, chunk)
+                    await supervisor.call(module_client.send_message_to_output, msg, "vibration")
+                    metrics.inc("vibration_chunks_sent_total")
+                    metrics.inc("vibration_bytes_sent_total", len(msg.data))
+                    print("Vibration chunk of %d samples sent, %d bytes" % (len(chunk), len(msg.data)))
+                except Exception as e:
+                    print("Error sending vibration data %s" % e)
+
+        async def sendPeriodically():
+            # deadlines are based on the monotonic loop clock and advance by readInterval, so they do not drift;
+            # deadlines missed while a send was retried are skipped instead of sending a burst to catch up
+            nextSend = loop.time() + readInterval
+            while True:
+                behind = loop.time() - nextSend
+                if behind > 0:
+                    nextSend += (int(behind // readInterval) + 1) * readInterval
+                await asyncio.sleep(nextSend - loop.time())
+                nextSend += readInterval
+                if not supervisor.connected:
+                    print("Not connected, the readings are sent with the next interval")
+                    continue
+                try:
                     print("sending...")
+                    started = time.perf_counter()
                     await sendData()
-                
-                    # msg = Message('{"temperature":' + str(t) +',"pressure":'+str(p)+',"humidity":'+str(h)+'}')
-                    # print("Sending message: %s" % msg)
-                    # msg.message_id = uuid.uuid4()
-                    # msg.correlation_id = "senseHat-"+str(uuid.uuid4())
-                    # msg.content_encoding = "utf-8"
-                    # msg.content_type = "application/json"                    
-                    # await module_client.send_message_to_output(msg, "sensors")
-                    # print("Message sent")
-
-                    counter = readInterval
-                    start = time.time()
-
-                # time.sleep(readInterval)
-            except Exception as e:
-                print("Error reading sensors %s" % e)
+                    metrics.observe("send_data_duration_seconds", time.perf_counter() - started)
+                except Exception as e:
+                    print("Error sending data %s" % e)
+
+        async def reportSamplingStatistics():
+            # the jitter of every sensor (in ms) is reported as module twin reported property
+            while True:
+                await asyncio.sleep(jitterReportInterval)
+                try:
+                    report = {
+                        "SampleRates": sampler.rates,
+                        "SamplingJitter": sampler.jitter(),
+                        "SamplesDropped": sampler.dropped,
+                        "SampleOverruns": sampler.overruns,
+                        "MessagesSuppressed": reportFilter.suppressed,
+                        "Metrics": metrics.report()
+                    }
+                    print("Sampling statistics: %s" % report)
+                    await module_client.patch_twin_reported_properties(report)
+                except Exception as e:
+                    print("Error reporting sampling statistics %s" % e)
+
+        jitterReportInterval = float(os.environ.get('JitterReportInterval', 60))
+
+        metricsServer = None
+        try:
+            if metricsPort:
+                try:
+                    # all interfaces, so the port can be published from the container
+                    metricsServer = await start_metrics_server(metrics, "0.0.0.0", metricsPort)
+                    print("Metrics endpoint on port %s" % metricsPort)
+                except OSError as e:
+                    # e.g. the port is in use, the module runs without the endpoint
+                    print("Metrics endpoint on port %s not started: %s" % (metricsPort, e))
+            tasks = [aggregateSamples(), sendPeriodically(), reportSamplingStatistics()]
+            if vibration is not None:
+                print("Vibration stream: %d samples per chunk" % vibrationChunkSize)
+                tasks.append(sendVibrationChunks())
+            await asyncio.gather(*tasks)
+        finally:
+            sampler.stop()
+            await supervisor.stop()
+            if metricsServer is not None:
+                metricsServer.close()
 
         # Finally, shut down the client
         await module_client.shutdown()
@@ -0,0 +1,192 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for
+# full license information.
+
+# Lightweight metrics: counters, gauges and latency histograms.
+# report() returns a snapshot as a dict (e.g. to send as reported properties of the twin), with the rate per
+# second of every counter since the previous report. render() returns the Prometheus text format, which
+# start_metrics_server() serves on /metrics, so a local Prometheus (or curl) can scrape the process.
+# Not thread-safe: update the metrics from the event loop.
+import asyncio
+import bisect
+import time
+
+# upper bounds (in seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.0075, 0.01, 0.015, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 0.75, 1, 2.5, 5, 10, 30)
+
+# Custom message property with the creation time of a message (milliseconds since the epoch, UTC),
+# so a consumer can compute the lag from the device to the cloud
+CREATION_TIME_PROPERTY = "creationTimeMs"
+
+
+def creation_timestamp():
+    return str(int(time.time() * 1000))
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # one count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        # estimated from the buckets with linear interpolation, like histogram_quantile() in Prometheus,
+        # but never above the largest observed value
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                if index == len(self.buckets):
+                    return self.max
+                return min(lower + (self.buckets[index] - lower) * (rank - cumulative) / count, self.max)
+            cumulative += count
+        return self.max
+
+    def summary(self):
+        # in milliseconds, which reads better in the twin
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "meanMs": round(self.sum / self.count * 1000, 2),
+            "p50Ms": round(self.quantile(0.5) * 1000, 2),
+            "p95Ms": round(self.quantile(0.95) * 1000, 2),
+            "p99Ms": round(self.quantile(0.99) * 1000, 2),
+            "maxMs": round(self.max * 1000, 2)
+        }
+
+
+class Metrics:
+    # Metrics are created on first use. An optional label (e.g. the method name) keeps a separate
+    # counter or histogram per label value.
+
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._help = {}
+        self._started = time.monotonic()
+        self._last_report = self._started
+        self._last_counts = {}
+
+    def describe(self, name, text, label_name="label"):
+        # help text and the name of the label in the Prometheus format
+        self._help[name] = (text, label_name)
+
+    def inc(self, name, value=1, label=None):
+        key = (name, label)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name, function):
+        # function() returns the current value, e.g. the length of a queue; it is called on every report
+        self._gauges[name] = function
+
+    def observe(self, name, seconds, label=None):
+        key = (name, label)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def report(self):
+        now = time.monotonic()
+        elapsed = max(now - self._last_report, 1e-9)
+        self._last_report = now
+
+        report = {"uptimeSeconds": int(now - self._started)}
+        for (name, label), value in self._counters.items():
+            rate = (value - self._last_counts.get((name, label), 0)) / elapsed
+            self._last_counts[(name, label)] = value
+            self._set(report, name, label, {"total": value, "perSecond": round(rate, 2)})
+        for name, function in self._gauges.items():
+            report[name] = function()
+        for (name, label), histogram in self._histograms.items():
+            self._set(report, name, label, histogram.summary())
+        return report
+
+    def render(self):
+        lines = []
+        for (name, label), value in sorted(self._counters.items(), key=_sort_key):
+            lines += self._header(name, "counter", lines)
+            lines.append("{} {}".format(self._name(name, label), value))
+        for name, function in sorted(self._gauges.items()):
+            lines += self._header(name, "gauge", lines)
+            lines.append("{} {}".format(self._name(name), function()))
+        for (name, label), histogram in sorted(self._histograms.items(), key=_sort_key):
+            lines += self._header(name, "histogram", lines)
+            cumulative = 0
+            for bound, count in zip([str(bound) for bound in histogram.buckets] + ["+Inf"], histogram.counts):
+                cumulative += count
+                lines.append("{} {}".format(self._name(name, label, "_bucket", bound), cumulative))
+            lines.append("{} {}".format(self._name(name, label, "_sum"), histogram.sum))
+            lines.append("{} {}".format(self._name(name, label, "_count"), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def _header(self, name, metric_type, lines):
+        full_name = self.prefix + name
+        if "# TYPE {} {}".format(full_name, metric_type) in lines:
+            return []
+        header = ["# TYPE {} {}".format(full_name, metric_type)]
+        if name in self._help:
+            header.insert(0, "# HELP {} {}".format(full_name, self._help[name][0]))
+        return header
+
+    def _name(self, name, label=None, suffix="", bound=None):
+        labels = []
+        if label is not None:
+            label_name = self._help.get(name, (None, "label"))[1]
+            labels.append('{}="{}"'.format(label_name, str(label).replace("\\", "\\\\").replace('"', '\\"')))
+        if bound is not None:
+            labels.append('le="{}"'.format(bound))
+        return self.prefix + name + suffix + ("{" + ",".join(labels) + "}" if labels else "")
+
+    @staticmethod
+    def _set(report, name, label, value):
+        if label is None:
+            report[name] = value
+        else:
+            report.setdefault(name, {})[str(label)] = value
+
+
+def _sort_key(item):
+    (name, label), _ = item
+    return name, "" if label is None else str(label)
+
+
+async def start_metrics_server(metrics, host="127.0.0.1", port=9100):
+    # Minimal HTTP endpoint on the event loop: GET /metrics returns metrics.render()
+    async def handle(reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            # the headers are not needed, but read up to the empty line before answering
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] in (b"/", b"/metrics"):
+                status, body = "200 OK", metrics.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            header = "HTTP/1.1 {}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(status, len(body))
+            writer.write(header.encode("utf-8") + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
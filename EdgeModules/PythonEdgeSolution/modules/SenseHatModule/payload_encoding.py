@@ -0,0 +1,145 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for
+# full license information.
+
+# Pluggable telemetry payload encoders.
+#   json     compact JSON (uses orjson when it is installed)
+#   msgpack  MessagePack, requires the msgpack package
+#   cbor     CBOR, requires the cbor2 package
+#   struct   fixed schema of little-endian float32 values, smallest payload, no field names on the wire
+#
+# An encoder encodes single readings with encode() and combines already encoded readings into one
+# batch payload with join(), so a batch never has to be encoded twice. content_type, content_encoding
+# and properties are meant to be set on the IoT Hub message, so consumers know how to decode the body.
+import json
+import struct
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+class JsonEncoder:
+    name = "json"
+    content_type = "application/json"
+    content_encoding = "utf-8"
+    # a comma per item, brackets around the array
+    item_overhead = 1
+    batch_overhead = 2
+
+    def __init__(self):
+        self.properties = {}
+        if orjson is not None:
+            self._dumps = orjson.dumps
+        else:
+            encoder = json.JSONEncoder(separators=(',', ':'))
+            self._dumps = lambda obj: encoder.encode(obj).encode('utf-8')
+
+    def encode(self, obj):
+        return self._dumps(obj)
+
+    def join(self, encoded):
+        if len(encoded) == 1:
+            return encoded[0]
+        return b'[' + b','.join(encoded) + b']'
+
+
+class _ArrayHeaderEncoder:
+    # MessagePack and CBOR arrays are a header followed by the concatenated items
+    content_encoding = None
+    item_overhead = 0
+    batch_overhead = 5
+
+    def __init__(self):
+        self.properties = {}
+
+    def join(self, encoded):
+        if len(encoded) == 1:
+            return encoded[0]
+        return self._array_header(len(encoded)) + b''.join(encoded)
+
+
+class MessagePackEncoder(_ArrayHeaderEncoder):
+    name = "msgpack"
+    content_type = "application/x-msgpack"
+
+    def __init__(self):
+        if msgpack is None:
+            raise ValueError("The msgpack encoding requires the msgpack package (pip install msgpack)")
+        super().__init__()
+        self._packer = msgpack.Packer(use_bin_type=True)
+
+    def encode(self, obj):
+        return self._packer.pack(obj)
+
+    def _array_header(self, count):
+        return self._packer.pack_array_header(count)
+
+
+class CborEncoder(_ArrayHeaderEncoder):
+    name = "cbor"
+    content_type = "application/cbor"
+
+    def __init__(self):
+        if cbor2 is None:
+            raise ValueError("The cbor encoding requires the cbor2 package (pip install cbor2)")
+        super().__init__()
+
+    def encode(self, obj):
+        return cbor2.dumps(obj)
+
+    def _array_header(self, count):
+        # major type 4 (array) with the length as immediate value or 1/2/4 byte argument
+        if count < 24:
+            return bytes([0x80 | count])
+        if count < 0x100:
+            return bytes([0x98, count])
+        if count < 0x10000:
+            return b'\x99' + count.to_bytes(2, 'big')
+        return b'\x9a' + count.to_bytes(4, 'big')
+
+
+class StructEncoder:
+    # Every reading is packed as one record of float32 values in the order of `fields`.
+    # The field list travels in the payloadSchema message property, a batch is a sequence of records.
+    name = "struct"
+    content_type = "application/octet-stream"
+    content_encoding = None
+    item_overhead = 0
+    batch_overhead = 0
+
+    def __init__(self, fields):
+        if not fields:
+            raise ValueError("The struct encoding requires the list of fields")
+        self.fields = tuple(fields)
+        self._struct = struct.Struct('<' + 'f' * len(self.fields))
+        self.properties = {"payloadSchema": ','.join(self.fields) + ';<f'}
+
+    def encode(self, obj):
+        return self._struct.pack(*[obj[field] for field in self.fields])
+
+    def join(self, encoded):
+        return b''.join(encoded)
+
+
+def create_encoder(name, fields=None):
+    if name == "json":
+        return JsonEncoder()
+    if name == "msgpack":
+        return MessagePackEncoder()
+    if name == "cbor":
+        return CborEncoder()
+    if name == "struct":
+        return StructEncoder(fields)
+    raise ValueError("Unknown payload encoding '{}', use json, msgpack, cbor or struct".format(name))
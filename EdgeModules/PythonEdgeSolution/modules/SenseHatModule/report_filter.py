@@ -0,0 +1,83 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for
+# full license information.
+
+# Report by exception: a message is only sent when a value moved more than its deadband away from
+# the last value that was sent, or when nothing has been sent for `heartbeat` seconds.
+# With `delta` enabled, a message only contains the changed fields, as difference to the last sent
+# value. The heartbeat always sends the full values, so consumers can resynchronize.
+#
+# Configured with the module twin desired property ReportByException, e.g.
+#   {"enabled": true, "deadbands": {"temperature": 0.5, "humidity": 2}, "heartbeat": 300, "delta": false}
+# Fields without a deadband are reported on any change.
+
+import numbers
+
+FULL = "full"
+DELTA = "delta"
+
+
+class ReportByException:
+
+    def __init__(self):
+        self.enabled = False
+        self.deadbands = {}
+        self.heartbeat = 300
+        self.delta = False
+        self.suppressed = 0
+        self._last_sent = None
+        self._last_sent_time = None
+
+    def configure(self, settings):
+        enabled = bool(settings.get("enabled", self.enabled))
+        deadbands = settings.get("deadbands", self.deadbands)
+        heartbeat = float(settings.get("heartbeat", self.heartbeat))
+        delta = bool(settings.get("delta", self.delta))
+        if heartbeat <= 0:
+            raise ValueError("heartbeat must be greater than 0")
+        deadbands = {field: float(threshold) for field, threshold in deadbands.items() if threshold is not None}
+
+        self.enabled, self.deadbands, self.heartbeat, self.delta = enabled, deadbands, heartbeat, delta
+        # start over with a full message, so a change of the settings is visible right away
+        self._last_sent = None
+
+    @property
+    def settings(self):
+        return {"enabled": self.enabled, "deadbands": self.deadbands, "heartbeat": self.heartbeat, "delta": self.delta}
+
+    def filter(self, payload, now):
+        # returns (payload to send, FULL or DELTA), or (None, None) if the message is suppressed;
+        # `now` is a monotonic timestamp in seconds
+        if not self.enabled:
+            return payload, FULL
+
+        if self._last_sent is None or now - self._last_sent_time >= self.heartbeat:
+            return self._sent(payload, now), FULL
+
+        changed = {}
+        for field, value in payload.items():
+            last = self._last_sent.get(field)
+            if not _is_number(value) or not _is_number(last):
+                continue
+            if abs(value - last) > self.deadbands.get(field, 0):
+                changed[field] = value
+        if not changed:
+            self.suppressed += 1
+            return None, None
+
+        if not self.delta:
+            return self._sent(payload, now), FULL
+
+        report = {field: value - self._last_sent[field] for field, value in changed.items()}
+        self._last_sent.update(changed)
+        self._last_sent_time = now
+        return report, DELTA
+
+    def _sent(self, payload, now):
+        self._last_sent = {field: value for field, value in payload.items() if _is_number(value)}
+        self._last_sent_time = now
+        return payload
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
@@ -0,0 +1,132 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for
+# full license information.
+
+# Sensor sampling outside of the asyncio event loop.
+# The SenseHat calls block on I2C, so they run on a dedicated thread. Every sensor is sampled at its
+# own rate, on a schedule based on the monotonic clock (deadlines advance by a fixed period, so there
+# is no drift). Samples are handed to the event loop through an asyncio.Queue.
+# The jitter (how late a read started compared to its deadline) is tracked per sensor.
+
+import heapq
+import threading
+import time
+import asyncio
+
+from aggregator import TumblingWindow
+
+
+class SensorSampler:
+
+    def __init__(self, sensors, loop, max_queued=1000):
+        # sensors maps a sensor name to (read, period): read() returns a dict of channel -> value
+        # and is called every `period` seconds on the sampling thread
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self.dropped = 0
+        self.overruns = 0
+        self.errors = 0
+        self._reads = {}
+        self._periods = {}
+        for name, (read, period) in sensors.items():
+            _check_period(period)
+            self._reads[name] = read
+            self._periods[name] = period
+        self._jitter = {name: TumblingWindow(percentiles=(95,)) for name in sensors}
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._rescheduled = False
+        self._thread = threading.Thread(target=self._run, name="SensorSampler", daemon=True)
+
+    @property
+    def rates(self):
+        with self._condition:
+            return {name: 1.0 / period for name, period in self._periods.items()}
+
+    def set_rate(self, name, rate):
+        # change the sample rate (in Hz) of a sensor; may be called from any thread
+        if name not in self._reads:
+            raise ValueError("Unknown sensor '%s'" % name)
+        period = 1.0 / rate if rate > 0 else 0
+        _check_period(period)
+        with self._condition:
+            self._periods[name] = period
+            # wake up the sampling thread, so it reschedules with the new period
+            self._rescheduled = True
+            self._condition.notify()
+
+    def jitter(self, reset=True):
+        # jitter statistics in milliseconds per sensor, since the last reset
+        with self._condition:
+            summary = {name: window.summary() for name, window in self._jitter.items()}
+            if reset:
+                for window in self._jitter.values():
+                    window.reset()
+        return summary
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        now = time.monotonic()
+        schedule = [(now, name) for name in self._reads]
+        heapq.heapify(schedule)
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    if self._rescheduled:
+                        # a shorter period takes effect right away instead of after the pending (longer) deadline
+                        now = time.monotonic()
+                        schedule = [(min(deadline, now + self._periods[name]), name) for deadline, name in schedule]
+                        heapq.heapify(schedule)
+                        self._rescheduled = False
+                    delay = schedule[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                if self._stopped:
+                    return
+                deadline, name = heapq.heappop(schedule)
+                period = self._periods[name]
+
+            started = time.monotonic()
+            try:
+                sample = self.read(name)
+            except Exception as e:
+                self.errors += 1
+                print("Error reading sensor %s: %s" % (name, e))
+            else:
+                self.loop.call_soon_threadsafe(self._enqueue, sample)
+
+            with self._condition:
+                self._jitter[name].add((started - deadline) * 1000.0)
+
+            deadline += period
+            behind = time.monotonic() - deadline
+            if behind >= 0:
+                # the read took longer than the period: skip the missed deadlines instead of bursting to catch up
+                missed = int(behind // period) + 1
+                self.overruns += missed
+                deadline += missed * period
+            heapq.heappush(schedule, (deadline, name))
+
+    def read(self, name):
+        return self._reads[name]()
+
+    def _enqueue(self, sample):
+        # runs on the event loop; when the consumer falls behind, the oldest sample is dropped
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(sample)
+
+
+def _check_period(period):
+    if period <= 0:
+        raise ValueError("The sample rate must be greater than 0")
@@ -0,0 +1,142 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for
+# full license information.
+
+# Raw accelerometer stream for vibration analysis.
+# The samples are buffered per axis in typed arrays (array('f')). A full chunk is reduced to features
+# (RMS, peak, crest factor and the dominant frequencies of the FFT, computed with NumPy) and encoded
+# as a compact binary payload: a header, then the samples of every axis quantized to int16, axis after
+# axis, compressed with zlib. NumPy is installed with the module; without it (e.g. when run off-device) only RMS,
+# peak and crest factor are computed.
+#
+# Payload (little-endian): header "<4sBBHfdfI" = magic b"VIBR", version, number of axes, reserved,
+# sample rate (Hz), time of the first sample (seconds since the epoch), scale (g per LSB), samples per axis;
+# followed by the zlib-compressed int16 samples. decode_chunk() reverses it.
+import array
+import math
+import struct
+import sys
+import time
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FORMAT = "int16-planar-zlib"
+AXES = ("X", "Y", "Z")
+MAGIC = b"VIBR"
+VERSION = 1
+HEADER = struct.Struct("<4sBBHfdfI")
+INT16_MAX = 32767
+
+
+class VibrationBuffer:
+    # add() returns a VibrationChunk when chunk_size samples per axis are buffered, otherwise None
+
+    def __init__(self, sample_rate, chunk_size=1024, scale=0.001):
+        if chunk_size < 2 or sample_rate <= 0:
+            raise ValueError("chunk_size must be at least 2 and sample_rate positive")
+        self.sample_rate = sample_rate
+        self.chunk_size = chunk_size
+        self.scale = scale
+        self._axes = [array.array("f") for _ in AXES]
+        self._started = None
+
+    def __len__(self):
+        return len(self._axes[0])
+
+    def add(self, x, y, z):
+        if not self._axes[0]:
+            self._started = time.time()
+        self._axes[0].append(x)
+        self._axes[1].append(y)
+        self._axes[2].append(z)
+        if len(self._axes[0]) >= self.chunk_size:
+            return self.flush()
+        return None
+
+    def set_sample_rate(self, sample_rate):
+        # a chunk holds samples of one rate only: returns the samples buffered so far as a (shorter) chunk
+        chunk = self.flush() if len(self) >= 2 else None
+        self._axes = [array.array("f") for _ in AXES]
+        self.sample_rate = sample_rate
+        return chunk
+
+    def flush(self):
+        if not self._axes[0]:
+            return None
+        chunk = VibrationChunk(self._axes, self.sample_rate, self._started, self.scale)
+        self._axes = [array.array("f") for _ in AXES]
+        self._started = None
+        return chunk
+
+
+class VibrationChunk:
+
+    def __init__(self, axes, sample_rate, started, scale):
+        self.axes = axes
+        self.sample_rate = sample_rate
+        self.started = started
+        self.scale = scale
+
+    def __len__(self):
+        return len(self.axes[0])
+
+    def features(self, frequencies=3):
+        # per axis, without the static part (gravity): rms, peak and crestFactor in g,
+        # and the `frequencies` strongest frequencies in Hz (with NumPy)
+        features = {}
+        for name, samples in zip(AXES, self.axes):
+            if numpy is not None:
+                values = numpy.frombuffer(samples, dtype=numpy.float32).astype(numpy.float64)
+                values = values - values.mean()
+                rms = float(numpy.sqrt(numpy.mean(values * values)))
+                peak = float(numpy.max(numpy.abs(values)))
+            else:
+                mean = sum(samples) / len(samples)
+                values = [value - mean for value in samples]
+                rms = math.sqrt(sum(value * value for value in values) / len(values))
+                peak = max(abs(value) for value in values)
+            axis = {"rms": rms, "peak": peak, "crestFactor": peak / rms if rms else 0.0}
+            if numpy is not None:
+                axis["dominantFrequencies"] = self._dominant_frequencies(values, frequencies)
+            features[name] = axis
+        return features
+
+    def _dominant_frequencies(self, values, count):
+        # the strongest local maxima of the spectrum, so the bins next to a peak do not count as frequencies
+        # of their own; Hann window against leakage, the DC bin is skipped
+        spectrum = numpy.abs(numpy.fft.rfft(values * numpy.hanning(len(values))))
+        bins = numpy.fft.rfftfreq(len(values), 1.0 / self.sample_rate)
+        inner = spectrum[1:-1]
+        peaks = numpy.nonzero((inner > spectrum[:-2]) & (inner >= spectrum[2:]))[0] + 1
+        strongest = peaks[numpy.argsort(spectrum[peaks])[::-1][:count]]
+        return [round(float(bins[index]), 2) for index in strongest]
+
+    def encode(self, level=6):
+        header = HEADER.pack(MAGIC, VERSION, len(AXES), 0, self.sample_rate, self.started or 0.0, self.scale, len(self))
+        return header + zlib.compress(b"".join(self._quantize(samples) for samples in self.axes), level)
+
+    def _quantize(self, samples):
+        if numpy is not None:
+            values = numpy.frombuffer(samples, dtype=numpy.float32) / self.scale
+            return numpy.clip(numpy.rint(values), -INT16_MAX, INT16_MAX).astype("<i2").tobytes()
+        quantized = array.array("h", (max(-INT16_MAX, min(INT16_MAX, int(round(value / self.scale)))) for value in samples))
+        if sys.byteorder == "big":
+            quantized.byteswap()
+        return quantized.tobytes()
+
+
+def decode_chunk(payload):
+    # returns (header, axes): the header as dict, the samples in g as a list per axis
+    magic, version, axis_count, _, sample_rate, started, scale, count = HEADER.unpack_from(payload)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a vibration chunk of version %d" % VERSION)
+    samples = array.array("h", zlib.decompress(payload[HEADER.size:]))
+    if sys.byteorder == "big":
+        samples.byteswap()
+    axes = [[value * scale for value in samples[index * count:(index + 1) * count]] for index in range(axis_count)]
+    header = {"sampleRate": sample_rate, "started": started, "scale": scale, "count": count}
+    return header, axes
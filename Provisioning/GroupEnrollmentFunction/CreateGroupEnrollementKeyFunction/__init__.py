@@ -1,17 +1,39 @@
 import os
+import json
 import logging
+import threading
+import time
 
 import azure.functions as func
 from provisioningserviceclient import ProvisioningServiceClient
 
-import hashlib
-import hmac
-import base64
+from shared_code.key_derivation import get_derived_device_key, derive_device_keys
+
+# The primary key of the enrollment group is cached by the Function instance for this many seconds.
+# Pass refreshkey=true to fetch it again right away, e.g. after the key has been rotated.
+ATTESTATION_KEY_TTL = int(os.getenv('AttestationKeyCacheSeconds', '300'))
+# maximum number of device ids in one batch request
+MAX_BATCH_SIZE = int(os.getenv('MaxBatchSize', '100000'))
+
+_attestation_key_lock = threading.Lock()
+_attestation_key = None
+_attestation_key_expiry = 0
 
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
 
+    if req.params.get('refreshkey', '').lower() == 'true':
+        invalidate_attestation_key()
+
+    # NDJSON batch: one device id per line, either as JSON string or as {"deviceid": "..."}
+    if 'ndjson' in req.headers.get('content-type', ''):
+        try:
+            device_ids = parse_ndjson_device_ids(req.get_body())
+        except ValueError as error:
+            return func.HttpResponse(str(error), status_code=400)
+        return create_batch_response(device_ids, ndjson=True)
+
     device_id = req.params.get('deviceid')
     if not device_id:
         try:
@@ -19,7 +41,13 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         except ValueError:
             pass
         else:
-            device_id = req_body.get('deviceid')
+            # JSON batch: a list of device ids, or {"deviceids": [...]}
+            if isinstance(req_body, list):
+                return create_batch_response(req_body)
+            if isinstance(req_body, dict):
+                if 'deviceids' in req_body:
+                    return create_batch_response(req_body['deviceids'])
+                device_id = req_body.get('deviceid')
 
     if device_id:
         attestation_key = get_attestation_key()
@@ -33,7 +61,47 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         )
 
 
+def create_batch_response(device_ids, ndjson=False):
+    if not isinstance(device_ids, list) or not all(isinstance(device_id, str) and device_id for device_id in device_ids):
+        return func.HttpResponse("The batch must be a list of device ids.", status_code=400)
+    if len(device_ids) > MAX_BATCH_SIZE:
+        return func.HttpResponse("A batch must not contain more than {} device ids.".format(MAX_BATCH_SIZE), status_code=413)
+
+    device_keys = derive_device_keys(device_ids, get_attestation_key())
+    if ndjson:
+        body = ''.join(json.dumps({"deviceid": device_id, "key": key}) + '\n' for device_id, key in device_keys)
+        return func.HttpResponse(body, mimetype='application/x-ndjson')
+    return func.HttpResponse(json.dumps(dict(device_keys)), mimetype='application/json')
+
+
+def parse_ndjson_device_ids(body):
+    device_ids = []
+    for line in body.decode('utf-8').splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        entry = json.loads(line)
+        device_ids.append(entry.get('deviceid') if isinstance(entry, dict) else entry)
+    return device_ids
+
+
 def get_attestation_key():
+    # Returns the cached primary key of the enrollment group, it is fetched from DPS when the cache expired
+    global _attestation_key, _attestation_key_expiry
+    with _attestation_key_lock:
+        if _attestation_key is None or time.monotonic() >= _attestation_key_expiry:
+            _attestation_key = fetch_attestation_key()
+            _attestation_key_expiry = time.monotonic() + ATTESTATION_KEY_TTL
+        return _attestation_key
+
+
+def invalidate_attestation_key():
+    global _attestation_key
+    with _attestation_key_lock:
+        _attestation_key = None
+
+
+def fetch_attestation_key():
     connection_string = os.environ['DpsConnectionString']
     psc = ProvisioningServiceClient.create_from_connection_string(connection_string)
     group_name = os.environ['DpsEnrollmentGroupName']
@@ -41,10 +109,3 @@ def get_attestation_key():
     primary_key = attestation_mechanism.symmetric_key.primary_key
     return primary_key
 
-
-def get_derived_device_key(registration_id, key):
-    message = bytes(registration_id, 'utf-8')
-    secret = base64.b64decode(key)
-
-    signature = base64.b64encode(hmac.new(secret, message, digestmod=hashlib.sha256).digest())
-    return signature
@@ -0,0 +1,121 @@
+# Offline bulk derivation of device keys for a DPS symmetric key group enrollment.
+# Uses the same derivation as the CreateGroupEnrollementKeyFunction (shared_code/key_derivation.py),
+# spread over all CPU cores with a process pool. The output is streamed, so the input can be of any size.
+#
+#   python bulk_derive_keys.py --key <group primary key> --input devices.txt --format csv > keys.csv
+#   cat devices.txt | python bulk_derive_keys.py --format ndjson
+#   python bulk_derive_keys.py --benchmark 1000000
+#
+# The group key can also be passed in the DPS_GROUP_KEY environment variable, so it does not end up in the shell history.
+import argparse
+import base64
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from shared_code.key_derivation import derive_device_keys
+
+_group_key = None
+
+
+def _init_worker(key):
+    global _group_key
+    _group_key = key
+
+
+def _derive_chunk(registration_ids):
+    return derive_device_keys(registration_ids, _group_key)
+
+
+def read_device_ids(lines):
+    for line in lines:
+        device_id = line.strip()
+        if device_id:
+            yield device_id
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def derive_keys_parallel(device_ids, key, processes=None, chunk_size=10000):
+    # Yields (device id, derived key) in input order; chunks are derived in parallel by the worker processes
+    with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(key,)) as pool:
+        for chunk in pool.imap(_derive_chunk, chunked(device_ids, chunk_size)):
+            yield from chunk
+
+
+def write_keys(device_keys, output, output_format):
+    count = 0
+    if output_format == "csv":
+        writer = csv.writer(output)
+        writer.writerow(("deviceid", "key"))
+        for device_key in device_keys:
+            writer.writerow(device_key)
+            count += 1
+    elif output_format == "ndjson":
+        for device_id, key in device_keys:
+            output.write(json.dumps({"deviceid": device_id, "key": key}) + "\n")
+            count += 1
+    else:
+        # a JSON object, written entry by entry
+        output.write("{")
+        for device_id, key in device_keys:
+            output.write((",\n" if count else "\n") + json.dumps(device_id) + ": " + json.dumps(key))
+            count += 1
+        output.write("\n}\n")
+    return count
+
+
+def benchmark(count, processes, chunk_size):
+    key = base64.b64encode(os.urandom(64)).decode("utf-8")
+    device_ids = ("device-{:09d}".format(index) for index in range(count))
+    start = time.perf_counter()
+    derived = sum(1 for _ in derive_keys_parallel(device_ids, key, processes, chunk_size))
+    elapsed = time.perf_counter() - start
+    print("Derived {} keys with {} processes in {:.2f} s: {:.0f} keys/s".format(derived, processes or os.cpu_count(), elapsed, derived / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Derive device keys for a DPS symmetric key group enrollment.")
+    parser.add_argument("--key", default=os.getenv("DPS_GROUP_KEY"), help="primary key of the enrollment group (default: DPS_GROUP_KEY)")
+    parser.add_argument("--input", help="file with one device id per line (default: stdin)")
+    parser.add_argument("--output", help="output file (default: stdout)")
+    parser.add_argument("--format", choices=("csv", "json", "ndjson"), default="csv")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="device ids per work item")
+    parser.add_argument("--benchmark", type=int, metavar="COUNT", help="derive COUNT keys for generated device ids with a random group key and report keys/s")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.processes, args.chunk_size)
+        return
+    if not args.key:
+        parser.error("the group key is required (--key or DPS_GROUP_KEY)")
+
+    input_file = open(args.input, "r") if args.input else sys.stdin
+    output_file = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        start = time.perf_counter()
+        device_keys = derive_keys_parallel(read_device_ids(input_file), args.key, args.processes, args.chunk_size)
+        count = write_keys(device_keys, output_file, args.format)
+        elapsed = time.perf_counter() - start
+        print("Derived {} keys in {:.2f} s".format(count, elapsed), file=sys.stderr)
+    finally:
+        if args.input:
+            input_file.close()
+        if args.output:
+            output_file.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+# Derivation of device keys for a symmetric key group enrollment in DPS:
+# the device key is the HMAC-SHA256 of the registration id, keyed with the primary key of the group.
+# No Azure dependencies, so it is shared by the Function and the bulk_derive_keys.py command line tool.
+import hashlib
+import hmac
+import base64
+
+
+def get_derived_device_key(registration_id, key):
+    message = bytes(registration_id, 'utf-8')
+    secret = base64.b64decode(key)
+
+    signature = base64.b64encode(hmac.new(secret, message, digestmod=hashlib.sha256).digest())
+    return signature
+
+
+def derive_device_keys(registration_ids, key):
+    # Same as get_derived_device_key for many devices; the group key is only decoded once.
+    # Returns a list of (registration id, derived key) tuples.
+    secret = base64.b64decode(key)
+    return [(registration_id, base64.b64encode(hmac.digest(secret, bytes(registration_id, 'utf-8'), 'sha256')).decode('utf-8'))
+            for registration_id in registration_ids]
@@ -4,14 +4,41 @@ from azure.storage.blob import generate_container_sas
 from azure.iot.hub import DigitalTwinClient
 import azure.functions as func
 
+from shared_code.idempotency import ProcessedEvents
+
 import os
 import sys
 import logging
 import json
-from datetime import datetime, timedelta
+import math
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 connect_timeout_in_seconds = 10
 response_timeout_in_seconds = 10
+# number of devices that are called in parallel, a slow device only holds one of the slots
+max_concurrent_commands = int(os.getenv("MAX_CONCURRENT_COMMANDS", "16"))
+
+# The stored access policy is valid for an hour and only renewed (together with the SAS token)
+# when less than sas_renew_before of its validity is left
+access_policy_id = 'my-access-policy-id'
+sas_validity = timedelta(hours=1)
+sas_renew_before = timedelta(minutes=10)
+
+# custom message property set by the device with the creation time of the message (milliseconds since the epoch, UTC)
+creation_time_property = 'creationTimeMs'
+# custom message property with the id of the request, it is passed back to the device with the response
+request_id_property = 'requestId'
+
+# Event Hub delivers at least once: the keys of processed events are remembered (at most IDEMPOTENCY_CACHE_SIZE,
+# in IDEMPOTENCY_CACHE_FILE as well if set, to survive a restart) and an event delivered again is skipped
+idempotency_cache_size = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+idempotency_cache_file = os.getenv("IDEMPOTENCY_CACHE_FILE")
+# a trigger without request id from a device that got the response less than COALESCE_WINDOW_SECONDS ago is answered by that call
+coalesce_window = float(os.getenv("COALESCE_WINDOW_SECONDS", "10"))
 
 try:
     CONNECTION_STRING = os.environ['AZURE_STORAGE_CONNECTION_STRING']
@@ -31,27 +58,261 @@ except KeyError:
     print("IOTHUB_CONNECTION_STRING must be set.")
     sys.exit(1)
 
+# Clients and the SAS token are kept for the lifetime of the (warm) Function instance and shared by all invocations
+_cache_lock = threading.Lock()
+_container_client = None
+_digital_twin_client = None
+_sas_token = None
+_sas_token_expiry = None
+_processed_events = ProcessedEvents(idempotency_cache_size, idempotency_cache_file)
+# monotonic time of the last successful call per device, for coalescing
+_last_calls = OrderedDict()
+
 def main(events: List[func.EventHubEvent]):
-    for event in events:
+    # Collect the devices of the batch and the ids of their requests. A device that sent several requests
+    # in the batch is only called once, with the ids of all its requests. Events that have been processed
+    # before (redelivered by Event Hub) are skipped.
+    device_requests = {}
+    device_events = {}
+    batch_keys = set()
+    duplicates = 0
+    lags = []
+    ingestion_lags = []
+    now = time.time()
+    for index, event in enumerate(events):
         logging.info('Python EventHub trigger processed an event: %s', event.get_body().decode('utf-8'))
 
+        lag = get_device_to_cloud_lag(event, index, now)
+        if lag is not None:
+            lags.append(lag[0])
+            if lag[1] is not None:
+                ingestion_lags.append(lag[1])
+
         try:
             device_id = event.iothub_metadata["connection-device-id"]
-            token = create_container_access_token()
-            call_device_method(device_id, "TriggerDeviceToCloudServiceResponse", token)
+        except (KeyError, TypeError):
+            logging.warning('Event without connection-device-id skipped')
+            continue
+        key = get_event_key(event, index)
+        if key is not None:
+            if key in batch_keys or key in _processed_events:
+                duplicates += 1
+                continue
+            batch_keys.add(key)
+            device_events.setdefault(device_id, []).append(key)
+        request_ids = device_requests.setdefault(device_id, [])
+        request_id = get_event_properties(event, index).get(request_id_property)
+        if request_id and request_id not in request_ids:
+            request_ids.append(request_id)
+
+    # the lag relies on the clocks of the devices being synchronized (e.g. with NTP)
+    if lags:
+        logging.info('Device-to-cloud lag of %d event(s): %s', len(lags), summarize_durations(lags))
+    if ingestion_lags:
+        logging.info('Device-to-IoT Hub lag: %s', summarize_durations(ingestion_lags))
+    if duplicates:
+        logging.info('Skipped %d event(s) that have already been processed', duplicates)
+
+    coalesced = [device_id for device_id, request_ids in device_requests.items() if not request_ids and was_called_recently(device_id)]
+    if coalesced:
+        logging.info('Coalesced the triggers of %d device(s) called within the last %.0f s', len(coalesced), coalesce_window)
+        for device_id in coalesced:
+            del device_requests[device_id]
+            _processed_events.add(device_events.get(device_id, []))
+
+    if not device_requests:
+        _processed_events.save()
+        return
+
+    try:
+        token = get_container_access_token()
+    except Exception as error:
+        logging.error('Could not create the container access token: %s', error)
+        return
+
+    payloads = {device_id: create_response_payload(request_ids, token) for device_id, request_ids in device_requests.items()}
+    results = call_device_methods(payloads, "TriggerDeviceToCloudServiceResponse")
+    summary = {}
+    for device_id, (status, _, _) in results.items():
+        summary[status] = summary.get(status, 0) + 1
+        if status == "succeeded":
+            # only events of devices that got the response count as processed, the others are retried when delivered again
+            _processed_events.add(device_events.get(device_id, []))
+            record_call(device_id)
+    _processed_events.save()
+    logging.info('Called %d device(s) for %d event(s): %s', len(payloads), len(events), summary)
+    logging.info('Method round-trip: %s', summarize_durations([seconds for _, _, seconds in results.values()]))
+
+
+def create_response_payload(request_ids, response):
+    # A device that stamped its requests with ids gets them back together with the response, so it can
+    # complete the matching requests. Devices without request ids get the plain response, as before.
+    if not request_ids:
+        return response
+    return {"requestIds": request_ids, "response": response}
+
+
+def call_device_methods(payloads, command_name):
+    # Invoke the command on all devices (the keys of payloads) with their payload in parallel, with at most max_concurrent_commands calls at a time.
+    # Returns the outcome and the round-trip time in seconds per device id:
+    # ("succeeded", result, seconds), ("timeout", error, seconds) or ("failed", error, seconds)
+    def timed_call(device_id):
+        started = time.perf_counter()
+        try:
+            return call_device_method(device_id, command_name, payloads[device_id]), None, time.perf_counter() - started
         except Exception as error:
-            print(error)
+            return None, error, time.perf_counter() - started
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(max_concurrent_commands, len(payloads))) as executor:
+        futures = {device_id: executor.submit(timed_call, device_id) for device_id in payloads}
+        for device_id, future in futures.items():
+            result, error, seconds = future.result()
+            if error is None:
+                results[device_id] = ("succeeded", result, seconds)
+            else:
+                status = "timeout" if is_timeout(error) else "failed"
+                logging.warning('Calling %s on %s %s after %.0f ms: %s', command_name, device_id, status, seconds * 1000, error)
+                results[device_id] = (status, error, seconds)
+    return results
+
+
+def was_called_recently(device_id):
+    with _cache_lock:
+        called = _last_calls.get(device_id)
+    return called is not None and time.monotonic() - called < coalesce_window
+
+
+def record_call(device_id):
+    with _cache_lock:
+        _last_calls[device_id] = time.monotonic()
+        _last_calls.move_to_end(device_id)
+        while len(_last_calls) > idempotency_cache_size:
+            _last_calls.popitem(last=False)
+
+
+def get_event_key(event, index):
+    # Identifies an event across deliveries: the request id set by the device, else the message id,
+    # else the partition and sequence number of the event. None if the event has none of them.
+    request_id = get_event_properties(event, index).get(request_id_property)
+    if request_id:
+        return "request:" + str(request_id)
+    system_properties = get_event_properties(event, index, "SystemProperties")
+    message_id = system_properties.get("message-id")
+    if message_id:
+        return "message:" + str(message_id)
+    sequence_number = getattr(event, "sequence_number", None)
+    if sequence_number is None:
+        sequence_number = system_properties.get("x-opt-sequence-number")
+    if sequence_number is None:
+        return None
+    metadata = getattr(event, "metadata", None) or {}
+    partition_id = (metadata.get("PartitionContext") or {}).get("PartitionId")
+    return "sequence:{}/{}".format(partition_id, sequence_number)
+
+
+def get_event_properties(event, index, name="Properties"):
+    # Application properties (or with name "SystemProperties" the system properties) of the message. With
+    # cardinality "many" the trigger metadata holds the properties of all events of the batch in PropertiesArray.
+    metadata = getattr(event, "metadata", None) or {}
+    properties = metadata.get(name)
+    if properties is None:
+        properties_array = metadata.get(name + "Array") or []
+        properties = properties_array[index] if index < len(properties_array) else None
+    return properties or {}
+
+
+def get_device_to_cloud_lag(event, index, now):
+    # Seconds from the creation of the message on the device until now, and until it was enqueued
+    # by IoT Hub (None if the enqueued time is unknown). None for messages without a creation time.
+    try:
+        created = int(get_event_properties(event, index)[creation_time_property]) / 1000.0
+    except (KeyError, TypeError, ValueError):
+        return None
+    enqueued_time = getattr(event, "enqueued_time", None)
+    if enqueued_time is None:
+        return now - created, None
+    if enqueued_time.tzinfo is None:
+        enqueued_time = enqueued_time.replace(tzinfo=timezone.utc)
+    return now - created, enqueued_time.timestamp() - created
+
+
+def summarize_durations(durations):
+    durations = sorted(durations)
+    return 'mean {:.0f} ms, p95 {:.0f} ms, max {:.0f} ms'.format(
+        sum(durations) / len(durations) * 1000, durations[math.ceil(0.95 * len(durations)) - 1] * 1000, durations[-1] * 1000)
+
+
+def is_timeout(error):
+    # IoT Hub answers 504 when the device did not respond within the response timeout
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None) == 504 or "timeout" in str(error).lower()
+
+
+def get_container_client():
+    global _container_client
+    with _cache_lock:
+        if _container_client is None:
+            # read again, so a client created after a key rotation uses the current app setting
+            service_client = BlobServiceClient.from_connection_string(os.environ.get('AZURE_STORAGE_CONNECTION_STRING', CONNECTION_STRING))
+            _container_client = service_client.get_container_client(CONTAINER_NAME)
+        return _container_client
+
+
+def get_digital_twin_client():
+    global _digital_twin_client
+    with _cache_lock:
+        if _digital_twin_client is None:
+            _digital_twin_client = DigitalTwinClient(IOTHUB_CONNECTION_STRING)
+        return _digital_twin_client
 
 
 def create_container_access_token():
-    service_client = BlobServiceClient.from_connection_string(CONNECTION_STRING)
-    container_client = service_client.get_container_client(CONTAINER_NAME)
+    # Returns the cached SAS token, the access policy is only written again when it is about to expire
+    global _sas_token, _sas_token_expiry
+    container_client = get_container_client()
+    with _cache_lock:
+        now = datetime.utcnow()
+        if _sas_token is None or now >= _sas_token_expiry - sas_renew_before:
+            _sas_token_expiry = now + sas_validity
+            _sas_token = issue_container_access_token(container_client, now, _sas_token_expiry)
+            logging.info('Issued a new container SAS token, valid until %s', _sas_token_expiry)
+        return _sas_token
+
+
+def get_container_access_token():
+    # A failed authentication (e.g. after the storage account key has been rotated) drops the cached client
+    # and token, and the token is issued once more with a new client
+    try:
+        return create_container_access_token()
+    except Exception as error:
+        if not is_authentication_error(error):
+            raise
+        logging.warning('Authentication with the storage account failed, creating a new client: %s', error)
+        invalidate_container_access_token()
+        return create_container_access_token()
+
+
+def is_authentication_error(error):
+    # ClientAuthenticationError and HttpResponseError of azure-core carry the HTTP status
+    return getattr(error, "status_code", None) in (401, 403)
+
+
+def invalidate_container_access_token():
+    # the client holds the account key, so it is dropped together with the token
+    global _container_client, _sas_token, _sas_token_expiry
+    with _cache_lock:
+        _container_client = None
+        _sas_token = None
+        _sas_token_expiry = None
+
 
-    # Create access policyF
+def issue_container_access_token(container_client, start, expiry):
+    # Create access policy
     access_policy = AccessPolicy(permission=ContainerSasPermissions(read=True),
-                                 expiry=datetime.utcnow() + timedelta(hours=1),
-                                 start=datetime.utcnow() - timedelta(minutes=1))
-    identifiers = {'my-access-policy-id': access_policy}
+                                 expiry=expiry,
+                                 start=start - timedelta(minutes=1))
+    identifiers = {access_policy_id: access_policy}
 
     # Set the access policy on the container
     container_client.set_container_access_policy(signed_identifiers=identifiers)
@@ -61,13 +322,13 @@ def create_container_access_token():
         container_client.account_name,
         container_client.container_name,
         account_key=container_client.credential.account_key,
-        policy_id='my-access-policy-id'
+        policy_id=access_policy_id
     )
 
     return sas_token
 
 def call_device_method(device_id, command_name, payload):
-    digital_twin_client = DigitalTwinClient(IOTHUB_CONNECTION_STRING)
+    digital_twin_client = get_digital_twin_client()
 
     invoke_command_result = digital_twin_client.invoke_command(
         device_id, command_name, payload, connect_timeout_in_seconds, response_timeout_in_seconds
@@ -75,4 +336,5 @@ def call_device_method(device_id, command_name, payload):
     if invoke_command_result:
         print(invoke_command_result)
     else:
-        print("No invoke_command_result found")
\ No newline at end of file
+        print("No invoke_command_result found")
+    return invoke_command_result
@@ -0,0 +1,72 @@
+# Idempotent processing of Event Hub events.
+# Event Hub delivers at least once: after a restart or a rebalance of the partitions the events since the last
+# checkpoint are delivered again. ProcessedEvents remembers the keys of the events that have been processed
+# (bounded, the least recently used keys are dropped first) and optionally persists them in a local file,
+# so a restarted Function instance skips them as well. No Azure dependencies.
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+
+class ProcessedEvents:
+
+    def __init__(self, max_entries=10000, path=None):
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+        self.max_entries = max_entries
+        self.path = path
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self._changed = False
+        if path:
+            self._load()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key not in self._keys:
+                return False
+            self._keys.move_to_end(key)
+            return True
+
+    def add(self, keys):
+        with self._lock:
+            for key in keys:
+                self._keys[key] = True
+                self._keys.move_to_end(key)
+            while len(self._keys) > self.max_entries:
+                self._keys.popitem(last=False)
+            self._changed = True
+
+    def save(self):
+        # writes the keys to a temporary file and replaces the file, so a crash never leaves a partial file
+        if not self.path:
+            return
+        with self._lock:
+            if not self._changed:
+                return
+            keys = list(self._keys)
+            self._changed = False
+        temporary = self.path + ".tmp"
+        try:
+            with open(temporary, "w") as f:
+                json.dump(keys, f)
+            os.replace(temporary, self.path)
+        except OSError as error:
+            logging.warning('Could not save the processed events to %s: %s', self.path, error)
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                keys = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as error:
+            logging.warning('Could not load the processed events from %s: %s', self.path, error)
+            return
+        for key in keys[-self.max_entries:]:
+            self._keys[key] = True